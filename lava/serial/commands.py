@@ -16,7 +16,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+import socket
 import sys
+import time
 
 import serial as pyserial
 
@@ -24,6 +28,30 @@ from lava_tool.interface import Command, SubCommand
 from lava.serial.direct import DirectSerialLine
 from lava.serial.console import Console
 from lava.serial import miniterm
+from lava.serial.mux import (
+    DEFAULT_WINDOW,
+    MultiplexClient,
+    MultiplexServer,
+    parse_address,
+)
+from lava.serial.ring import RingError, RingReader, default_ring_path
+from lava.serial.simulator import (
+    BoardFarm,
+    LoadDriver,
+    load_boot_log,
+    synthetic_boot_log,
+)
+from lava.serial.trace import Tracer
+from lava.serial.uart import ERROR_FIELDS
+
+
+def _save_trace(tracer, filename):
+    try:
+        with open(filename, "w") as stream:
+            tracer.dump(stream)
+    except IOError as exc:
+        sys.stderr.write("could not save trace to %r: %s\n" % (
+            filename, exc))
 
 
 class SerialCommand(SubCommand):
@@ -54,6 +82,7 @@ class ConsoleCommand(Command):
         --network will open a TCP/IP socket and
         connect to that device. The device can be
         exposed with `lava-tool serial service`
+        and is selected with --line
 
         --managed will open a connection to LAVA
         server and access a serial line defined there
@@ -84,12 +113,35 @@ class ConsoleCommand(Command):
         connection_group.add_argument(
             "--network",
             metavar="IP:PORT",
-            help="connect to a TCP/IP socket")
+            type=parse_address,
+            help=("connect to a TCP/IP socket exposed by"
+                  " `lava serial service` (see --line)"))
         connection_group.add_argument(
             "--managed",
             metavar="URL/device",
             help="connect to a LAVA Server with Serial extension")
 
+        network_group = parser.add_argument_group(title="network options")
+
+        network_group.add_argument("--line",
+            dest="line",
+            metavar="DEVICE",
+            help="serial line to open on the remote service")
+
+        network_group.add_argument("--compress",
+            dest="compress",
+            action="store_true",
+            help=("ask the service to compress the connection"
+                  " (default off)"),
+            default=False)
+
+        parser.add_argument("--share",
+            dest="share",
+            action="store_true",
+            help=("share received data of a --direct line with local"
+                  " readers (see `lava serial tail`)"),
+            default=False)
+
         serial_group = parser.add_argument_group(title="serial line settings")
 
         serial_group.add_argument("-b", "--baud",
@@ -187,15 +239,51 @@ class ConsoleCommand(Command):
     3: hex dump everything""",
             default=0)
 
-    def _config_miniterm(self, serial, console):
+        terminal_group.add_argument("--timestamps",
+            dest="timestamps",
+            nargs="?",
+            choices=miniterm.TIMESTAMP_MODES,
+            const=miniterm.TIMESTAMP_RELATIVE,
+            help=("prefix each received line with the wall clock time"
+                  " (absolute) or the time since the session started"
+                  " (relative, the default)"),
+            default=None)
+
+        terminal_group.add_argument("--timestamp-delta",
+            dest="timestamp_delta",
+            action="store_true",
+            help=("also show the time since the previous line"
+                  " (implies --timestamps)"),
+            default=False)
+
+        terminal_group.add_argument("--stats",
+            dest="stats",
+            metavar="FILE",
+            help=("save session statistics (including UART error counters"
+                  " where supported) to FILE as JSON on exit"),
+            default=None)
+
+        terminal_group.add_argument("--trace",
+            dest="trace",
+            metavar="FILE",
+            help=("record reads, writes and menu actions and save them to"
+                  " FILE in Chrome trace event format on exit"),
+            default=None)
+
+    def _config_miniterm(self, serial, console, tracer):
         if self.args.repr_mode > 3:
             self.args.repr_mode = 3
+        if self.args.timestamp_delta and self.args.timestamps is None:
+            self.args.timestamps = miniterm.TIMESTAMP_RELATIVE
         term = miniterm.Miniterm(
             serial,
             console,
             echo=self.args.echo,
             convert_outgoing=self.args.convert_cr_lf,
-            repr_mode=self.args.repr_mode)
+            repr_mode=self.args.repr_mode,
+            tracer=tracer,
+            timestamps=self.args.timestamps,
+            timestamp_delta=self.args.timestamp_delta)
         if not self.args.quiet:
             sys.stderr.write('--- Miniterm on %s: %d,%s,%s,%s ---\n' % (
                 serial.portstr,
@@ -225,7 +313,34 @@ class ConsoleCommand(Command):
             term.rts_state = self.args.rts_state
         return term
 
+    def _report_statistics(self, stats):
+        if not self.args.quiet:
+            sys.stderr.write(
+                "\n--- session: received %d bytes in %d reads (%.0f bytes/s),"
+                " sent %d bytes ---" % (
+                    stats['received'], stats['reads'],
+                    stats['receive_rate'], stats['sent']))
+            if 'uart' in stats:
+                sys.stderr.write(
+                    "\n--- UART: %s, peak rx %.0f bytes/s ---" % (
+                        ", ".join([
+                            "%s %d" % (name, stats['uart'][name])
+                            for name in ERROR_FIELDS]),
+                        stats['uart_peak_rx_rate']))
+        if self.args.stats:
+            try:
+                with open(self.args.stats, "w") as stream:
+                    json.dump(stats, stream, indent=2)
+            except IOError as exc:
+                sys.stderr.write("could not save statistics to %r: %s\n" % (
+                    self.args.stats, exc))
+
     def invoke(self):
+        client = None
+        if self.args.trace:
+            tracer = Tracer()
+        else:
+            tracer = None
         if self.args.direct:
             try:
                 serial = DirectSerialLine(
@@ -238,9 +353,39 @@ class ConsoleCommand(Command):
                 sys.stderr.write(
                     "could not open port %r: %s\n" % (self.args.direct, exc))
                 return 1
+            if self.args.share:
+                try:
+                    serial.start_sharing(default_ring_path(self.args.direct))
+                except EnvironmentError as exc:
+                    sys.stderr.write(
+                        "could not share port %r: %s\n" % (
+                            self.args.direct, exc))
+                    serial.close()
+                    return 1
         elif self.args.network:
-            raise NotImplementedError(
-                "Networked serial line is not implemented")
+            if self.args.line is None:
+                sys.stderr.write("--network requires --line\n")
+                return 1
+            client = MultiplexClient(
+                self.args.network, compression=self.args.compress,
+                tracer=tracer)
+            try:
+                client.connect()
+                serial = client.open_line(
+                    self.args.line,
+                    baudrate=self.args.baudrate,
+                    parity=self.args.parity,
+                    rtscts=self.args.rtscts,
+                    xonxoff=self.args.xonxoff)
+            except (socket.error, pyserial.SerialException) as exc:
+                sys.stderr.write(
+                    "could not open port %r on %s:%d: %s\n" % (
+                        self.args.line,
+                        self.args.network[0],
+                        self.args.network[1],
+                        exc))
+                client.close()
+                return 1
         elif self.args.managed:
             raise NotImplementedError("LAVA Server integration is not done")
         # Initialize our console object
@@ -249,7 +394,7 @@ class ConsoleCommand(Command):
             # Initialize our terminal object, we do it here
             # as it already touches the serial line and
             # could raise exceptions
-            terminal = self._config_miniterm(serial, console)
+            terminal = self._config_miniterm(serial, console, tracer)
             with console.grab():
                 # With a console grab (that essentially turns on per-keystroke
                 # reads) run the terminal until the user explicitly stops it
@@ -261,5 +406,351 @@ class ConsoleCommand(Command):
             terminal.stop()
             # And close the serial line
             serial.close()
+            # And the network connection, if any
+            if client is not None:
+                client.close()
+            if tracer is not None:
+                _save_trace(tracer, self.args.trace)
+        self._report_statistics(terminal.get_statistics())
+        if not self.args.quiet:
+            if client is not None:
+                sys.stderr.write("\n--- network: %s ---" % (client.stats,))
+            sys.stderr.write("\n--- exit ---\n")
+
+
+class ServiceCommand(Command):
+    """
+    Expose local serial lines over TCP/IP
+
+    All the serial lines given on the command line are exported
+    with a multiplexed protocol. A single connection can carry any
+    number of them, each with its own flow control window.
+    Use `lava serial console --network` to connect to one.
+    """
+
+    @classmethod
+    def get_name(cls):
+        return "service"
+
+    @classmethod
+    def register_arguments(cls, parser):
+        super(ServiceCommand, cls).register_arguments(parser)
+
+        parser.add_argument("-q", "--quiet",
+            dest="quiet",
+            action="store_true",
+            help="suppress non error messages",
+            default=False)
+
+        parser.add_argument("--listen",
+            metavar="IP:PORT",
+            type=parse_address,
+            help="address to listen on, default %(default)s",
+            default="localhost:9600")
+
+        parser.add_argument("--window",
+            dest="window",
+            type=int,
+            help="per-line flow control window in bytes, default %(default)d",
+            default=DEFAULT_WINDOW)
+
+        parser.add_argument("--no-compress",
+            dest="compress",
+            action="store_false",
+            help="refuse to compress connections (default is to compress"
+                 " when the client asks for it)",
+            default=True)
+
+        parser.add_argument("--share",
+            dest="share",
+            action="store_true",
+            help=("share received data of open lines with local readers"
+                  " (see `lava serial tail`)"),
+            default=False)
+
+        parser.add_argument("--trace",
+            dest="trace",
+            metavar="FILE",
+            help=("record serial and network activity and save it to FILE"
+                  " in Chrome trace event format on exit"),
+            default=None)
+
+        parser.add_argument("devices",
+            metavar="DEVICE",
+            nargs="+",
+            help="serial line to export (such as /dev/ttyUSB0)")
+
+    def _report_disconnect(self, address, stats):
+        if not self.args.quiet:
+            sys.stderr.write("--- %s:%d disconnected: %s ---\n" % (
+                address[0], address[1], stats))
+
+    def invoke(self):
+        if self.args.trace:
+            tracer = Tracer()
+        else:
+            tracer = None
+        server = MultiplexServer(
+            self.args.listen, self.args.devices,
+            window=self.args.window,
+            compression=self.args.compress,
+            disconnect_callback=self._report_disconnect,
+            share=self.args.share,
+            tracer=tracer)
+        try:
+            server.bind()
+        except socket.error as exc:
+            sys.stderr.write("could not listen on %s:%d: %s\n" % (
+                self.args.listen[0], self.args.listen[1], exc))
+            return 1
+        if not self.args.quiet:
+            sys.stderr.write("--- Serving %d serial line(s) on %s:%d ---\n" % (
+                len(self.args.devices),
+                self.args.listen[0],
+                self.args.listen[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            if tracer is not None:
+                _save_trace(tracer, self.args.trace)
+        if not self.args.quiet:
+            sys.stderr.write("\n--- exit ---\n")
+
+
+class TailCommand(Command):
+    """
+    Follow a serial line shared by its owner
+
+    The process that has the serial line open (`lava serial console
+    --direct --share` or `lava serial service --share`) copies everything
+    it receives to a shared memory ring. Any number of local readers can
+    follow it without disturbing the owner.
+    """
+
+    @classmethod
+    def get_name(cls):
+        return "tail"
+
+    @classmethod
+    def register_arguments(cls, parser):
+        super(TailCommand, cls).register_arguments(parser)
+
+        parser.add_argument("-q", "--quiet",
+            dest="quiet",
+            action="store_true",
+            help="suppress non error messages",
+            default=False)
+
+        parser.add_argument("--from-start",
+            dest="from_start",
+            action="store_true",
+            help="start with the oldest data still in the ring",
+            default=False)
+
+        parser.add_argument("device",
+            metavar="DEVICE",
+            help="shared serial line to follow (such as /dev/ttyUSB0)")
+
+    def invoke(self):
+        path = default_ring_path(self.args.device)
+        from_start = self.args.from_start
+        while True:
+            try:
+                reader = RingReader(path, from_start=from_start)
+            except (EnvironmentError, RingError) as exc:
+                sys.stderr.write(
+                    "could not follow port %r: %s\n" % (
+                        self.args.device, exc))
+                return 1
+            try:
+                for data, lost in reader.follow():
+                    if lost and not self.args.quiet:
+                        sys.stderr.write(
+                            "\n--- overrun, lost %d bytes ---\n" % lost)
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+                closed = reader.closed
+            except KeyboardInterrupt:
+                break
+            finally:
+                reader.close()
+            if closed or not os.path.exists(path):
+                if not self.args.quiet:
+                    sys.stderr.write("\n--- closed by owner ---\n")
+                break
+            # The owner went away without closing the ring and a new one
+            # took over, everything in the new ring is new to us
+            if not self.args.quiet:
+                sys.stderr.write("\n--- owner restarted ---\n")
+            from_start = True
         if not self.args.quiet:
             sys.stderr.write("\n--- exit ---\n")
+
+
+class SimulateCommand(Command):
+    """
+    Simulate a farm of boards on pseudo-terminals
+
+    Each simulated board replays a boot log (a synthetic one unless
+    --log is given) at the pace of the selected baud rate, with
+    optional bursts and idle gaps, and answers simple commands at its
+    prompt. The printed device paths can be used anywhere a serial
+    device is accepted, for example `lava serial console --direct`
+    and `lava serial service`.
+    """
+
+    @classmethod
+    def get_name(cls):
+        return "simulate"
+
+    @classmethod
+    def register_arguments(cls, parser):
+        super(SimulateCommand, cls).register_arguments(parser)
+
+        parser.add_argument("-q", "--quiet",
+            dest="quiet",
+            action="store_true",
+            help="suppress non error messages",
+            default=False)
+
+        farm_group = parser.add_argument_group(title="simulated boards")
+
+        farm_group.add_argument("-n", "--boards",
+            dest="boards",
+            type=int,
+            help="number of boards to simulate, default %(default)d",
+            default=1)
+
+        farm_group.add_argument("-b", "--baud",
+            dest="baudrate",
+            type=int,
+            help="pace output like this baud rate, default %(default)d",
+            default=115200)
+
+        farm_group.add_argument("--log",
+            dest="log",
+            metavar="FILE",
+            help="replay a recorded boot log (default: synthetic log)",
+            default=None)
+
+        farm_group.add_argument("--burst-chance",
+            dest="burst_chance",
+            type=float,
+            help=("probability that a line starts a burst of unpaced"
+                  " output, default %(default)s"),
+            default=0.0)
+
+        farm_group.add_argument("--burst-lines",
+            dest="burst_lines",
+            type=int,
+            help="number of lines in a burst, default %(default)d",
+            default=50)
+
+        farm_group.add_argument("--idle-chance",
+            dest="idle_chance",
+            type=float,
+            help=("probability that a line is preceded by an idle gap,"
+                  " default %(default)s"),
+            default=0.0)
+
+        farm_group.add_argument("--idle-time",
+            dest="idle_time",
+            type=float,
+            help="length of an idle gap in seconds, default %(default)s",
+            default=1.0)
+
+        farm_group.add_argument("--seed",
+            dest="seed",
+            type=int,
+            help="random seed for reproducible bursts and idle gaps",
+            default=None)
+
+    def _create_farm(self):
+        if self.args.log:
+            log = load_boot_log(self.args.log)
+        else:
+            log = synthetic_boot_log()
+        return BoardFarm(
+            self.args.boards, log,
+            baudrate=self.args.baudrate,
+            burst_chance=self.args.burst_chance,
+            burst_lines=self.args.burst_lines,
+            idle_chance=self.args.idle_chance,
+            idle_time=self.args.idle_time,
+            seed=self.args.seed)
+
+    def invoke(self):
+        if self.args.boards < 1:
+            sys.stderr.write("at least one board is needed\n")
+            return 1
+        try:
+            farm = self._create_farm()
+        except (EnvironmentError, ValueError) as exc:
+            sys.stderr.write("could not create simulated boards: %s\n" % exc)
+            return 1
+        try:
+            farm.start()
+            # The paths go to stdout so that they can be captured by scripts
+            for path in farm.paths:
+                sys.stdout.write("%s\n" % path)
+            sys.stdout.flush()
+            if not self.args.quiet:
+                sys.stderr.write(
+                    "--- Simulating %d board(s), interrupt to stop ---\n" % (
+                        len(farm.paths)))
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            farm.close()
+        if not self.args.quiet:
+            sys.stderr.write("\n--- exit ---\n")
+
+
+class LoadTestCommand(SimulateCommand):
+    """
+    Load-test the serial stack with simulated boards
+
+    A farm of simulated boards (see `lava serial simulate`) is read
+    through DirectSerialLine for the selected duration. Aggregate
+    throughput, dropped data and latency across all lines are reported
+    at the end.
+    """
+
+    @classmethod
+    def get_name(cls):
+        return "loadtest"
+
+    @classmethod
+    def register_arguments(cls, parser):
+        super(LoadTestCommand, cls).register_arguments(parser)
+
+        parser.add_argument("-t", "--duration",
+            dest="duration",
+            type=float,
+            help="length of the test in seconds, default %(default)s",
+            default=10.0)
+
+    def invoke(self):
+        if self.args.boards < 1:
+            sys.stderr.write("at least one board is needed\n")
+            return 1
+        try:
+            farm = self._create_farm()
+        except (EnvironmentError, ValueError) as exc:
+            sys.stderr.write("could not create simulated boards: %s\n" % exc)
+            return 1
+        try:
+            if not self.args.quiet:
+                sys.stderr.write(
+                    "--- Load testing %d board(s) for %.1fs ---\n" % (
+                        len(farm.paths), self.args.duration))
+            report = LoadDriver(farm, self.args.baudrate).run(
+                self.args.duration)
+        finally:
+            farm.close()
+        sys.stdout.write(str(report))
@@ -1,15 +1,33 @@
 import fcntl
 import errno
+import os
+import struct
+import termios
 
 import serial as pyserial
 
+from lava.serial.ring import DEFAULT_CAPACITY, DEFAULT_MODE, RingWriter
+
+
+# Linux struct serial_icounter_struct, eleven counters and reserved space
+TIOCGICOUNT = getattr(termios, "TIOCGICOUNT", 0x545D)
+ICOUNT = struct.Struct("20i")
+ICOUNT_FIELDS = (
+    'cts', 'dsr', 'rng', 'dcd', 'rx', 'tx',
+    'frame', 'overrun', 'parity', 'brk', 'buf_overrun')
+
 
 class DirectSerialLine(pyserial.Serial):
     """
     A subclass of serial.Serial that implements exclusive locking on
     the serial device
+
+    Since nobody else can open the device, the owner can share everything it
+    receives with other local processes, see start_sharing()
     """
 
+    _ring = None
+
     def open(self):
         """
         Open the serial port and lock the file descriptor used by the serial
@@ -30,3 +48,71 @@ class DirectSerialLine(pyserial.Serial):
                     "(perhaps somene is using it)")
             else:
                 raise
+
+    def get_icount(self):
+        """
+        Read the interrupt counters of the UART behind this serial line
+
+        Returns a dictionary with the counters named in ICOUNT_FIELDS or
+        None if the device does not support it (for example pseudo-terminals)
+        """
+        try:
+            data = fcntl.ioctl(self.fileno(), TIOCGICOUNT, "\0" * ICOUNT.size)
+        except IOError as exc:
+            if exc.errno in (errno.EINVAL, errno.ENOTTY, errno.EIO):
+                return None
+            raise
+        return dict(zip(ICOUNT_FIELDS, ICOUNT.unpack(data)))
+
+    def start_sharing(self, path, capacity=DEFAULT_CAPACITY,
+                      mode=DEFAULT_MODE):
+        """
+        Copy all received data to a shared memory ring at the specified path
+
+        Local processes can follow the ring with
+        :class:`lava.serial.ring.RingReader`. The ring file is created with
+        the specified mode, by default only the owner can read it.
+        """
+        self.stop_sharing()
+        self._ring = RingWriter(path, capacity, mode)
+
+    def stop_sharing(self):
+        """
+        Stop copying received data and remove the shared memory ring
+        """
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+    def read(self, size=1):
+        data = super(DirectSerialLine, self).read(size)
+        if self._ring is not None and data:
+            self._ring.write(data)
+        return data
+
+    def read_available(self, size):
+        """
+        Read at most size bytes that are already waiting, without blocking
+
+        Unlike read() this does not use select() so it works for any
+        descriptor number. Meant to be called once poll() said the line is
+        readable, returns an empty string if nothing is waiting after all.
+        """
+        try:
+            data = os.read(self.fileno(), size)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                return ''
+            raise pyserial.SerialException(
+                "read failed: %s" % (exc,))
+        if not data:
+            raise pyserial.SerialException(
+                "device reports readiness to read but returned no data"
+                " (device disconnected?)")
+        if self._ring is not None:
+            self._ring.write(data)
+        return data
+
+    def close(self):
+        self.stop_sharing()
+        super(DirectSerialLine, self).close()
@@ -7,9 +7,12 @@
 
 import sys
 import threading
+import time
 
 import serial as pyserial
 
+from lava.serial.uart import ERROR_FIELDS, UartMonitor
+
 
 EXITCHARCTER = '\x1d'   # GS/CTRL+]
 MENUCHARACTER = '\x14'  # Menu: CTRL+T
@@ -22,6 +25,18 @@ LF_MODES = ('LF', 'CR', 'CR/LF')
 
 REPR_MODES = ('raw', 'some control', 'all control', 'hex')
 
+TIMESTAMP_ABSOLUTE = 'absolute'
+TIMESTAMP_RELATIVE = 'relative'
+TIMESTAMP_MODES = (TIMESTAMP_ABSOLUTE, TIMESTAMP_RELATIVE)
+
+# escaped and hex dumped form of each character, as repr() would show it
+ESCAPE_TABLE = dict((chr(i), repr(chr(i))[1:-1]) for i in range(256))
+HEX_TABLE = dict((chr(i), '%02x ' % i) for i in range(256))
+
+
+def _escape(data):
+    return ''.join(map(ESCAPE_TABLE.__getitem__, data))
+
 
 def key_description(character):
     """generate a readable description for a key"""
@@ -77,7 +92,8 @@ def get_help_text():
 class Miniterm(object):
 
     def __init__(self, serial, console, echo=False,
-                 convert_outgoing=CONVERT_CRLF, repr_mode=0):
+                 convert_outgoing=CONVERT_CRLF, repr_mode=0, tracer=None,
+                 timestamps=None, timestamp_delta=False):
         self.serial = serial
         self.console = console
         self.echo = echo
@@ -88,6 +104,20 @@ class Miniterm(object):
         self.rts_state = True
         self.break_state = False
         self.alive = False
+        self.tracer = tracer
+        # one of TIMESTAMP_MODES or None
+        self.timestamps = timestamps
+        self.timestamp_delta = timestamp_delta
+        self._at_line_start = True
+        self._last_line_time = None
+        # session statistics
+        self.started = None
+        self.received = 0
+        self.reads = 0
+        self.sent = 0
+        self.uart_monitor = UartMonitor(serial)
+        # UART counters shown by the last info dump
+        self._uart_shown = None
 
     def run_until_stopped(self):
         try:
@@ -104,6 +134,8 @@ class Miniterm(object):
         self.serial.setWriteTimeout(1.0)
         # set alive so that threads keep looping
         self.alive = True
+        self.started = time.time()
+        self.uart_monitor.start()
         # start serial->console thread
         self.receiver_thread = threading.Thread(
             target=self._reader,
@@ -118,6 +150,58 @@ class Miniterm(object):
     def _join(self):
         self.transmitter_thread.join()
         self.receiver_thread.join()
+        self.uart_monitor.stop()
+        # final sample so that the statistics cover the whole session
+        self.uart_monitor.sample()
+
+    def get_statistics(self):
+        """return a dictionary with statistics of the session"""
+        elapsed = time.time() - self.started
+        stats = {
+            'duration': elapsed,
+            'received': self.received,
+            'reads': self.reads,
+            'sent': self.sent,
+            'receive_rate': self.received / elapsed,
+        }
+        if self.uart_monitor.supported:
+            stats['uart'] = self.uart_monitor.totals()
+            stats['uart_peak_rx_rate'] = self.uart_monitor.peak_rx_rate
+        return stats
+
+    def _dump_uart_counters(self):
+        monitor = self.uart_monitor
+        if not monitor.supported:
+            sys.stderr.write('--- UART counters: not supported by this port\n')
+            return
+        # The background thread samples often enough, sampling here would
+        # also cut short the interval that the current rate is measured over
+        sample = monitor.latest
+        since = self._uart_shown or monitor.first
+        self._uart_shown = sample
+        delta = sample.delta(since)
+        sys.stderr.write('--- UART rx: %d (+%d)  tx: %d (+%d)\n' % (
+            sample.counts['rx'], delta['rx'],
+            sample.counts['tx'], delta['tx']))
+        sys.stderr.write('--- UART %s\n' % '  '.join([
+            '%s: %d (+%d)' % (name, sample.counts[name], delta[name])
+            for name in ERROR_FIELDS]))
+        # start bit, data bits, parity bit and stop bits
+        bits = (1 + self.serial.bytesize
+                + (self.serial.parity != pyserial.PARITY_NONE)
+                + self.serial.stopbits)
+        capacity = float(self.serial.baudrate) / bits
+        rate, peak = monitor.rx_rate(), monitor.peak_rx_rate
+        sys.stderr.write(
+            '--- UART throughput: now %.0f bytes/s (%.0f%% of line capacity)'
+            '  peak %.0f bytes/s (%.0f%%)\n' % (
+                rate, 100 * rate / capacity, peak, 100 * peak / capacity))
+        first_rx = sample.counts['rx'] - monitor.first.counts['rx']
+        sys.stderr.write(
+            '--- read %d of %d received bytes in %d reads'
+            ' (%.1f bytes per read)\n' % (
+                self.received, first_rx, self.reads,
+                self.reads and float(self.received) / self.reads or 0.0))
 
     def _dump_port_settings(self):
         sys.stderr.write("\n--- Settings: %s  %s,%s,%s,%s\n" % (
@@ -155,41 +239,119 @@ class Miniterm(object):
             # on RFC 2217 ports it can happen to no modem state notification
             # was yet received. ignore this error.
             pass
+        except EnvironmentError:
+            # pseudo-terminals have no modem lines at all
+            pass
+        self._dump_uart_counters()
+
+    def _render(self, data):
+        """render a chunk of received data for the console"""
+        if self.repr_mode == 0:
+            # direct output, just have to care about newline setting
+            if self.convert_outgoing == CONVERT_CR:
+                return data.replace('\r', '\n')
+            else:
+                return data
+        elif self.repr_mode == 1:
+            # escape non-printable, let pass newlines
+            if self.convert_outgoing == CONVERT_CRLF:
+                lines = data.replace('\r', '').split('\n')
+            elif self.convert_outgoing == CONVERT_LF:
+                lines = data.split('\n')
+            elif self.convert_outgoing == CONVERT_CR:
+                lines = data.split('\r')
+            return '\n'.join([_escape(line) for line in lines])
+        elif self.repr_mode == 2:
+            # escape all non-printable, including newline
+            return _escape(data)
+        elif self.repr_mode == 3:
+            # escape everything (hexdump)
+            return ''.join(map(HEX_TABLE.__getitem__, data))
+
+    def _format_timestamp(self, now, delta):
+        if self.timestamps == TIMESTAMP_ABSOLUTE:
+            stamp = '%s.%06d' % (
+                time.strftime('%H:%M:%S', time.localtime(now)),
+                now % 1 * 1000000)
+        else:
+            stamp = '%11.6f' % (now - self.started)
+        if self.timestamp_delta:
+            stamp += ' +%.6f' % delta
+        return '[%s] ' % stamp
+
+    def _render_timestamped(self, data, now):
+        """render a chunk of received data line by line, prefixing each line
+        that starts in the chunk with a timestamp"""
+        # line breaks are found in the received data, the escaping repr
+        # modes do not render them as newlines
+        if self.convert_outgoing == CONVERT_CR:
+            newline = '\r'
+        else:
+            newline = '\n'
+        pieces = data.split(newline)
+        # all pieces but the last one end with a line break, the last one
+        # is empty if the chunk ends with a line break
+        last = len(pieces) - 1
+        rendered = []
+        prefix = None
+        for index, piece in enumerate(pieces):
+            if index < last:
+                piece += newline
+            elif not piece:
+                break
+            text = self._render(piece)
+            if self._at_line_start:
+                # all lines in one chunk were received at the same time,
+                # only the first one can have a non-zero delta
+                if prefix is None:
+                    if self._last_line_time is None:
+                        delta = 0.0
+                    else:
+                        delta = now - self._last_line_time
+                    self._last_line_time = now
+                    rendered.append(self._format_timestamp(now, delta))
+                    prefix = self._format_timestamp(now, 0.0)
+                else:
+                    rendered.append(prefix)
+            rendered.append(text)
+            if index < last and self.repr_mode >= 2:
+                # keep the escaped line break and start a new console line
+                # after it
+                rendered.append('\n')
+            self._at_line_start = index < last
+        return ''.join(rendered)
 
     def _reader(self):
         """loop and copy serial->console"""
+        # tracing is off unless a tracer was given, keep the checks cheap
+        tracer = self.tracer
+        timestamps = self.timestamps
         try:
             while self.alive:
-                data = self.serial.read(1)
-
-                if self.repr_mode == 0:
-                    # direct output, just have to care about newline setting
-                    if data == '\r' and self.convert_outgoing == CONVERT_CR:
-                        sys.stdout.write('\n')
-                    else:
-                        sys.stdout.write(data)
-                elif self.repr_mode == 1:
-                    # escape non-printable, let pass newlines
-                    if (self.convert_outgoing == CONVERT_CRLF
-                        and data in '\r\n'):
-                        if data == '\n':
-                            sys.stdout.write('\n')
-                        elif data == '\r':
-                            pass
-                    elif data == '\n' and self.convert_outgoing == CONVERT_LF:
-                        sys.stdout.write('\n')
-                    elif data == '\r' and self.convert_outgoing == CONVERT_CR:
-                        sys.stdout.write('\n')
-                    else:
-                        sys.stdout.write(repr(data)[1:-1])
-                elif self.repr_mode == 2:
-                    # escape all non-printable, including newline
-                    sys.stdout.write(repr(data)[1:-1])
-                elif self.repr_mode == 3:
-                    # escape everything (hexdump)
-                    for character in data:
-                        sys.stdout.write("%s " % character.encode('hex'))
+                if tracer is not None:
+                    start = time.time()
+                # wait for at least one byte, then take everything that
+                # arrived in the meantime
+                data = self.serial.read(self.serial.inWaiting() or 1)
+                if data:
+                    self.received += len(data)
+                    self.reads += 1
+                if tracer is not None:
+                    end = time.time()
+                    tracer.record("read", start, end)
+                    start = end
+                if timestamps is None:
+                    text = self._render(data)
+                else:
+                    text = self._render_timestamped(data, time.time())
+                if tracer is not None:
+                    end = time.time()
+                    tracer.record("render", start, end)
+                    start = end
+                sys.stdout.write(text)
                 sys.stdout.flush()
+                if tracer is not None:
+                    tracer.record("write", start, time.time())
         except pyserial.SerialException:
             self.alive = False
             # would be nice if the console reader could be interruptted at this
@@ -202,166 +364,184 @@ class Miniterm(object):
            locally.
         """
         menu_active = False
+        tracer = self.tracer
         try:
             while self.alive:
                 try:
                     c = self.console.getkey()
                 except KeyboardInterrupt:
                     c = '\x03'
+                if tracer is not None:
+                    start = time.time()
                 if menu_active:
-                    if c == MENUCHARACTER or c == EXITCHARCTER:
-                        # Menu character again/exit char -> send itself
-                        self.serial.write(c)  # send character
-                        if self.echo:
-                            sys.stdout.write(c)
-                    elif c == '\x15':
-                        # CTRL+U -> upload file
-                        sys.stderr.write('\n--- File to upload: ')
-                        sys.stderr.flush()
-                        self.console.cleanup()
-                        filename = sys.stdin.readline().rstrip('\r\n')
-                        if filename:
-                            try:
-                                file = open(filename, 'r')
-                                sys.stderr.write(
-                                    '--- Sending file %s ---\n' % filename)
-                                while True:
-                                    line = file.readline().rstrip('\r\n')
-                                    if not line:
-                                        break
-                                    self.serial.write(line)
-                                    self.serial.write('\r\n')
-                                    # Wait for output buffer to drain.
-                                    self.serial.flush()
-                                    # Progress indicator.
-                                    sys.stderr.write('.')
-                                sys.stderr.write(
-                                    '\n--- File %s sent ---\n' % filename)
-                            except IOError, e:
+                    try:
+                        if c == MENUCHARACTER or c == EXITCHARCTER:
+                            # Menu character again/exit char -> send itself
+                            self.serial.write(c)  # send character
+                            self.sent += 1
+                            if self.echo:
+                                sys.stdout.write(c)
+                        elif c == '\x15':
+                            # CTRL+U -> upload file
+                            sys.stderr.write('\n--- File to upload: ')
+                            sys.stderr.flush()
+                            self.console.cleanup()
+                            filename = sys.stdin.readline().rstrip('\r\n')
+                            if filename:
+                                try:
+                                    file = open(filename, 'r')
+                                    sys.stderr.write(
+                                        '--- Sending file %s ---\n' % filename)
+                                    while True:
+                                        line = file.readline().rstrip('\r\n')
+                                        if not line:
+                                            break
+                                        self.serial.write(line)
+                                        self.serial.write('\r\n')
+                                        self.sent += len(line) + 2
+                                        # Wait for output buffer to drain.
+                                        self.serial.flush()
+                                        # Progress indicator.
+                                        sys.stderr.write('.')
+                                    sys.stderr.write(
+                                        '\n--- File %s sent ---\n' % filename)
+                                except IOError, e:
+                                    sys.stderr.write(
+                                        '--- ERROR opening file %s: %s ---\n'
+                                        % (filename, e))
+                            self.console.setup()
+                        elif c in '\x08hH?':
+                            # CTRL+H, h, H, ? -> Show help
+                            sys.stderr.write(get_help_text())
+                        elif c == '\x12':
+                            # CTRL+R -> Toggle RTS
+                            self.serial.setRTS(not self.rts_state)
+                            self.rts_state = not self.rts_state
+                            sys.stderr.write('--- RTS %s ---\n' % (
+                                self.rts_state and 'active' or 'inactive'))
+                        elif c == '\x04':
+                            # CTRL+D -> Toggle DTR
+                            self.serial.setDTR(not self.dtr_state)
+                            self.dtr_state = not self.dtr_state
+                            sys.stderr.write('--- DTR %s ---\n' % (
+                                self.dtr_state and 'active' or 'inactive'))
+                        elif c == '\x02':
+                            # CTRL+B -> toggle BREAK condition
+                            self.serial.setBreak(not self.break_state)
+                            self.break_state = not self.break_state
+                            sys.stderr.write('--- BREAK %s ---\n' % (
+                                self.break_state and 'active' or 'inactive'))
+                        elif c == '\x05':
+                            # CTRL+E -> toggle local echo
+                            self.echo = not self.echo
+                            sys.stderr.write('--- local echo %s ---\n' % (
+                                self.echo and 'active' or 'inactive'))
+                        elif c == '\x09':
+                            # CTRL+I -> info
+                            self._dump_port_settings()
+                        elif c == '\x01':
+                            # CTRL+A -> cycle escape mode
+                            self.repr_mode += 1
+                            if self.repr_mode > 3:
+                                self.repr_mode = 0
+                            sys.stderr.write('--- escape data: %s ---\n' % (
+                                REPR_MODES[self.repr_mode],))
+                        elif c == '\x0c':
+                            # CTRL+L -> cycle linefeed mode
+                            self.convert_outgoing += 1
+                            if self.convert_outgoing > 2:
+                                self.convert_outgoing = 0
+                            self.newline = NEWLINE_CONVERISON_MAP[
+                                self.convert_outgoing]
+                            sys.stderr.write('--- line feed %s ---\n' % (
+                                LF_MODES[self.convert_outgoing],))
+                        #~ elif c in 'pP':
+                            # P -> change port XXX reader thread would exit
+                        elif c in 'bB':
+                            # B -> change baudrate
+                            sys.stderr.write('\n--- Baudrate: ')
+                            sys.stderr.flush()
+                            self.console.cleanup()
+                            backup = self.serial.baudrate
+                            new_baudrate = sys.stdin.readline().strip()
+                            if new_baudrate:
+                                try:
+                                    self.serial.baudrate = int(
+                                        sys.stdin.readline().strip())
+                                except (ValueError,
+                                        pyserial.SerialException), e:
+                                    sys.stderr.write(
+                                        '--- ERROR setting baudrate: %s ---\n'
+                                        % (e,))
+                                    self.serial.baudrate = backup
+                                else:
+                                    self._dump_port_settings()
+                            else: 
                                 sys.stderr.write(
-                                    '--- ERROR opening file %s: %s ---\n' % (
-                                        filename, e))
-                        self.console.setup()
-                    elif c in '\x08hH?':
-                        # CTRL+H, h, H, ? -> Show help
-                        sys.stderr.write(get_help_text())
-                    elif c == '\x12':
-                        # CTRL+R -> Toggle RTS
-                        self.rts_state = not self.rts_state
-                        self.serial.setRTS(self.rts_state)
-                        sys.stderr.write('--- RTS %s ---\n' % (
-                            self.rts_state and 'active' or 'inactive'))
-                    elif c == '\x04':
-                        # CTRL+D -> Toggle DTR
-                        self.dtr_state = not self.dtr_state
-                        self.serial.setDTR(self.dtr_state)
-                        sys.stderr.write('--- DTR %s ---\n' % (
-                            self.dtr_state and 'active' or 'inactive'))
-                    elif c == '\x02':
-                        # CTRL+B -> toggle BREAK condition
-                        self.break_state = not self.break_state
-                        self.serial.setBreak(self.break_state)
-                        sys.stderr.write('--- BREAK %s ---\n' % (
-                            self.break_state and 'active' or 'inactive'))
-                    elif c == '\x05':
-                        # CTRL+E -> toggle local echo
-                        self.echo = not self.echo
-                        sys.stderr.write('--- local echo %s ---\n' % (
-                            self.echo and 'active' or 'inactive'))
-                    elif c == '\x09':
-                        # CTRL+I -> info
-                        self._dump_port_settings()
-                    elif c == '\x01':
-                        # CTRL+A -> cycle escape mode
-                        self.repr_mode += 1
-                        if self.repr_mode > 3:
-                            self.repr_mode = 0
-                        sys.stderr.write('--- escape data: %s ---\n' % (
-                            REPR_MODES[self.repr_mode],))
-                    elif c == '\x0c':
-                        # CTRL+L -> cycle linefeed mode
-                        self.convert_outgoing += 1
-                        if self.convert_outgoing > 2:
-                            self.convert_outgoing = 0
-                        self.newline = NEWLINE_CONVERISON_MAP[
-                            self.convert_outgoing]
-                        sys.stderr.write('--- line feed %s ---\n' % (
-                            LF_MODES[self.convert_outgoing],))
-                    #~ elif c in 'pP':
-                        # P -> change port XXX reader thread would exit
-                    elif c in 'bB':
-                        # B -> change baudrate
-                        sys.stderr.write('\n--- Baudrate: ')
-                        sys.stderr.flush()
-                        self.console.cleanup()
-                        backup = self.serial.baudrate
-                        new_baudrate = sys.stdin.readline().strip()
-                        if new_baudrate:
-                            try:
-                                self.serial.baudrate = int(
-                                    sys.stdin.readline().strip())
-                            except ValueError, e:
-                                sys.stderr.write(
-                                    '--- ERROR setting baudrate: %s ---\n' % (e,))
-                                self.serial.baudrate = backup
-                            else:
-                                self._dump_port_settings()
-                        else: 
-                            sys.stderr.write('--- Baud rate not changed ---\n')
-                        self.console.setup()
-                    elif c == '8':
-                        # 8 -> change to 8 bits
-                        self.serial.bytesize = pyserial.EIGHTBITS
-                        self._dump_port_settings()
-                    elif c == '7':
-                        # 7 -> change to 8 bits
-                        self.serial.bytesize = pyserial.SEVENBITS
-                        self._dump_port_settings()
-                    elif c in 'eE':
-                        # E -> change to even parity
-                        self.serial.parity = pyserial.PARITY_EVEN
-                        self._dump_port_settings()
-                    elif c in 'oO':
-                        # O -> change to odd parity
-                        self.serial.parity = pyserial.PARITY_ODD
-                        self._dump_port_settings()
-                    elif c in 'mM':
-                        # M -> change to mark parity
-                        self.serial.parity = pyserial.PARITY_MARK
-                        self._dump_port_settings()
-                    elif c in 'sS':
-                        # S -> change to space parity
-                        self.serial.parity = pyserial.PARITY_SPACE
-                        self._dump_port_settings()
-                    elif c in 'nN':
-                        # N -> change to no parity
-                        self.serial.parity = pyserial.PARITY_NONE
-                        self._dump_port_settings()
-                    elif c == '1':
-                        # 1 -> change to 1 stop bits
-                        self.serial.stopbits = pyserial.STOPBITS_ONE
-                        self._dump_port_settings()
-                    elif c == '2':
-                        # 2 -> change to 2 stop bits
-                        self.serial.stopbits = pyserial.STOPBITS_TWO
-                        self._dump_port_settings()
-                    elif c == '3':
-                        # 3 -> change to 1.5 stop bits
-                        self.serial.stopbits = pyserial.STOPBITS_ONE_POINT_FIVE
-                        self._dump_port_settings()
-                    elif c in 'xX':
-                        # X -> change software flow control
-                        self.serial.xonxoff = (c == 'X')
-                        self._dump_port_settings()
-                    elif c in 'rR':
-                        # R -> change hardware flow control
-                        self.serial.rtscts = (c == 'R')
-                        self._dump_port_settings()
-                    else:
-                        sys.stderr.write(
-                            '--- unknown menu character %s --\n' % (
-                            key_description(c),))
+                                    '--- Baud rate not changed ---\n')
+                            self.console.setup()
+                        elif c == '8':
+                            # 8 -> change to 8 bits
+                            self.serial.bytesize = pyserial.EIGHTBITS
+                            self._dump_port_settings()
+                        elif c == '7':
+                            # 7 -> change to 8 bits
+                            self.serial.bytesize = pyserial.SEVENBITS
+                            self._dump_port_settings()
+                        elif c in 'eE':
+                            # E -> change to even parity
+                            self.serial.parity = pyserial.PARITY_EVEN
+                            self._dump_port_settings()
+                        elif c in 'oO':
+                            # O -> change to odd parity
+                            self.serial.parity = pyserial.PARITY_ODD
+                            self._dump_port_settings()
+                        elif c in 'mM':
+                            # M -> change to mark parity
+                            self.serial.parity = pyserial.PARITY_MARK
+                            self._dump_port_settings()
+                        elif c in 'sS':
+                            # S -> change to space parity
+                            self.serial.parity = pyserial.PARITY_SPACE
+                            self._dump_port_settings()
+                        elif c in 'nN':
+                            # N -> change to no parity
+                            self.serial.parity = pyserial.PARITY_NONE
+                            self._dump_port_settings()
+                        elif c == '1':
+                            # 1 -> change to 1 stop bits
+                            self.serial.stopbits = pyserial.STOPBITS_ONE
+                            self._dump_port_settings()
+                        elif c == '2':
+                            # 2 -> change to 2 stop bits
+                            self.serial.stopbits = pyserial.STOPBITS_TWO
+                            self._dump_port_settings()
+                        elif c == '3':
+                            # 3 -> change to 1.5 stop bits
+                            self.serial.stopbits = (
+                                pyserial.STOPBITS_ONE_POINT_FIVE)
+                            self._dump_port_settings()
+                        elif c in 'xX':
+                            # X -> change software flow control
+                            self.serial.xonxoff = (c == 'X')
+                            self._dump_port_settings()
+                        elif c in 'rR':
+                            # R -> change hardware flow control
+                            self.serial.rtscts = (c == 'R')
+                            self._dump_port_settings()
+                        else:
+                            sys.stderr.write(
+                                '--- unknown menu character %s --\n' % (
+                                key_description(c),))
+                    except pyserial.SerialException, e:
+                        # the port (or the server of a network line) did
+                        # not accept the change, nothing was changed
+                        sys.stderr.write('--- ERROR: %s ---\n' % (e,))
                     menu_active = False
+                    if tracer is not None:
+                        tracer.record(
+                            "menu %s" % key_description(c),
+                            start, time.time())
                 elif c == MENUCHARACTER:
                     # next char will be for menu
                     menu_active = True
@@ -372,16 +552,22 @@ class Miniterm(object):
                 elif c == '\n':
                     # send newline character(s)
                     self.serial.write(self.newline)
+                    self.sent += len(self.newline)
                     if self.echo:
                         # local echo is a real newline in any case
                         sys.stdout.write(c)
                         sys.stdout.flush()
+                    if tracer is not None:
+                        tracer.record("send", start, time.time())
                 else:
                     # send character
                     self.serial.write(c)
+                    self.sent += 1
                     if self.echo:
                         sys.stdout.write(c)
                         sys.stdout.flush()
+                    if tracer is not None:
+                        tracer.record("send", start, time.time())
         except:
             self.alive = False
             raise
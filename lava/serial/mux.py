@@ -0,0 +1,1036 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Multiplexed serial line protocol
+
+A single TCP/IP connection carries any number of serial lines (channels).
+Everything on the wire is a frame::
+
+    +------+---------+--------+---------------------+
+    | type | channel | length | payload (length)    |
+    | u8   | u16     | u16    |                     |
+    +------+---------+--------+---------------------+
+
+All integers are in network byte order. The connection starts with both
+sides exchanging a HELLO frame (channel 0) with a JSON payload describing
+the protocol version and the initial flow control window.
+
+The client HELLO may also offer a list of compression methods. The server
+picks one (or none) in its HELLO and, if one was picked, everything after
+the HELLO frames is a single zlib stream in each direction. Peers that do
+not know about compression ignore the offer and the connection simply
+stays uncompressed.
+
+Each channel has an independent, credit based, flow control window in
+each direction. A peer may only send as many DATA bytes on a channel as
+the other side has granted with the initial window and subsequent WINDOW
+frames. This way one busy serial line cannot starve the others sharing
+the same connection.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import resource
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import serial as pyserial
+
+from lava.serial.direct import DirectSerialLine
+from lava.serial.poll import poll
+from lava.serial.ring import default_ring_path
+from lava.serial.trace import acquire
+
+
+PROTOCOL_VERSION = 1
+
+FRAME_HELLO = 0
+FRAME_OPEN = 1
+FRAME_OPENED = 2
+FRAME_CLOSE = 3
+FRAME_DATA = 4
+FRAME_WINDOW = 5
+# Sent by the client to change port settings, the server answers each one
+# with a CONTROL frame that is either empty ({}) or reports the error
+FRAME_CONTROL = 6
+FRAME_ERROR = 7
+
+FRAME_HEADER = struct.Struct("!BHH")
+WINDOW_UPDATE = struct.Struct("!I")
+
+MAX_PAYLOAD = 0xFFFF
+MAX_CHANNEL = 0xFFFF
+# Largest chunk of serial data put in a single DATA frame
+MAX_CHUNK = 4096
+DEFAULT_WINDOW = 64 * 1024
+
+COMPRESSION_ZLIB = "zlib"
+# Serial traffic is mostly text, favour CPU time over compression ratio
+COMPRESSION_LEVEL = 1
+
+# getrusage() for the calling thread only (Linux), the resource module of
+# Python 2 does not have the constant
+RUSAGE_THREAD = 1
+
+# Port settings that can be changed with a CONTROL frame, they map directly
+# to pyserial attributes
+CONTROL_SETTINGS = (
+    'baudrate', 'bytesize', 'parity', 'stopbits', 'xonxoff', 'rtscts')
+# Line states that can be changed with a CONTROL frame, they map to pyserial
+# setter methods
+CONTROL_LINES = {
+    'dtr': 'setDTR',
+    'rts': 'setRTS',
+    'break': 'setBreak',
+}
+
+
+class ProtocolError(pyserial.SerialException):
+    """
+    Exception raised when the peer does not follow the protocol
+    """
+
+
+def parse_address(text):
+    """
+    Parse HOST:PORT into a (host, port) tuple suitable for socket functions
+
+    An empty host is allowed and means all interfaces.
+    """
+    host, sep, port = text.rpartition(":")
+    if not sep:
+        raise ValueError("address must look like HOST:PORT")
+    return host, int(port)
+
+
+def encode_frame(frame_type, channel, payload=''):
+    """
+    Encode a single frame
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("frame payload is too long")
+    return FRAME_HEADER.pack(frame_type, channel, len(payload)) + payload
+
+
+def _thread_cpu_time():
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+try:
+    _thread_cpu_time()
+except (ValueError, resource.error):
+    # zlib releases the GIL so this includes whatever other threads do in
+    # the meantime
+    _cpu_time = time.clock
+    CPU_TIME_IS_PER_THREAD = False
+else:
+    _cpu_time = _thread_cpu_time
+    CPU_TIME_IS_PER_THREAD = True
+
+
+class TransportStats(object):
+    """
+    Traffic statistics of one connection
+
+    Payload byte counts are measured before compression, wire byte counts
+    after it. The cost of compression is measured in seconds of CPU time
+    spent in zlib calls by the calling thread. Where the CPU time of a
+    single thread is not available (CPU_TIME_IS_PER_THREAD is False) the
+    CPU time of the whole process is used instead, which also counts other
+    threads running while zlib works, the figure is only an approximation
+    then.
+    """
+
+    def __init__(self):
+        self.compression = None
+        self.payload_sent = 0
+        self.wire_sent = 0
+        self.payload_received = 0
+        self.wire_received = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    @property
+    def ratio(self):
+        """
+        Overall compression ratio (payload bytes per wire byte)
+        """
+        wire = self.wire_sent + self.wire_received
+        if wire == 0:
+            return 1.0
+        return float(self.payload_sent + self.payload_received) / wire
+
+    def __str__(self):
+        return (
+            "sent %d bytes (%d on wire), received %d bytes (%d on wire),"
+            " compression %s, ratio %.2f, %.3fs CPU compressing,"
+            " %.3fs CPU decompressing" % (
+                self.payload_sent, self.wire_sent,
+                self.payload_received, self.wire_received,
+                self.compression or "off", self.ratio,
+                self.compress_time, self.decompress_time))
+
+
+class FrameCodec(object):
+    """
+    Stateful encoder and decoder of the frame stream of one connection
+
+    The stream may be switched to zlib compression with
+    :meth:`start_compression` once HELLO frames were exchanged. Compression
+    is streaming, each call to :meth:`pack` ends with a sync flush so that
+    everything packed so far can be decoded by the peer right away.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._compressor = None
+        self._decompressor = None
+        self.stats = TransportStats()
+
+    def start_compression(self, method):
+        """
+        Compress everything packed and unpacked from now on
+        """
+        if method != COMPRESSION_ZLIB:
+            raise ProtocolError("unsupported compression %r" % (method,))
+        self.stats.compression = method
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self._decompressor = zlib.decompressobj()
+        # Anything received after the HELLO frame is already compressed
+        pending, self._buffer = self._buffer, ''
+        self._buffer = self._decompress(pending)
+        self.stats.payload_received += len(self._buffer) - len(pending)
+
+    def _decompress(self, data):
+        start = _cpu_time()
+        try:
+            data = self._decompressor.decompress(data)
+        except zlib.error as exc:
+            raise ProtocolError("corrupted compressed stream: %s" % exc)
+        self.stats.decompress_time += _cpu_time() - start
+        return data
+
+    def pack(self, frames):
+        """
+        Encode a sequence of (type, channel, payload) tuples into bytes that
+        can be sent to the peer
+        """
+        data = ''.join([
+            encode_frame(frame_type, channel, payload)
+            for frame_type, channel, payload in frames])
+        self.stats.payload_sent += len(data)
+        if self._compressor is not None and data:
+            start = _cpu_time()
+            data = (self._compressor.compress(data)
+                    + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.stats.compress_time += _cpu_time() - start
+        self.stats.wire_sent += len(data)
+        return data
+
+    def unpack(self, data):
+        """
+        Feed bytes received from the peer and return a list of all the
+        complete (type, channel, payload) tuples decoded so far
+
+        Decoding stops after a HELLO frame so that the caller can switch
+        compression on before the rest of the stream is looked at. Call
+        unpack('') to decode any frames that follow it.
+        """
+        self.stats.wire_received += len(data)
+        if self._decompressor is not None and data:
+            data = self._decompress(data)
+        self.stats.payload_received += len(data)
+        self._buffer += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(self._buffer) - offset >= header_size:
+            frame_type, channel, length = FRAME_HEADER.unpack_from(
+                self._buffer, offset)
+            end = offset + header_size + length
+            if end > len(self._buffer):
+                break
+            frames.append(
+                (frame_type, channel, self._buffer[offset + header_size:end]))
+            offset = end
+            if frame_type == FRAME_HELLO:
+                break
+        self._buffer = self._buffer[offset:]
+        return frames
+
+
+def _hello_payload(window, compression):
+    return json.dumps({
+        "version": PROTOCOL_VERSION,
+        "window": window,
+        "compression": compression})
+
+
+def _parse_hello(frame_type, payload):
+    if frame_type != FRAME_HELLO:
+        raise ProtocolError("expected HELLO frame")
+    try:
+        hello = json.loads(payload)
+        version = hello["version"]
+        window = int(hello["window"])
+    except (ValueError, KeyError, TypeError):
+        raise ProtocolError("malformed HELLO frame")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("unsupported protocol version %r" % (version,))
+    return hello, window
+
+
+def apply_control(serial, control):
+    """
+    Apply a dictionary of port settings and line states to a serial object
+    """
+    for key, value in control.iteritems():
+        if key in CONTROL_SETTINGS:
+            setattr(serial, key, value)
+        elif key in CONTROL_LINES:
+            getattr(serial, CONTROL_LINES[key])(value)
+        else:
+            raise ValueError("unsupported control %r" % (key,))
+
+
+class _ServerChannel(object):
+    """
+    Server side state of a single channel
+    """
+
+    def __init__(self, conn, channel, serial, send_credit):
+        self.conn = conn
+        self.channel = channel
+        self.serial = serial
+        # Number of bytes we may still send to the client
+        self.send_credit = send_credit
+        # Data from the client that the device did not take yet, it never
+        # grows beyond the window we granted
+        self.outgoing = ''
+
+    def fileno(self):
+        return self.serial.fileno()
+
+
+class _ServerConnection(object):
+    """
+    Server side state of a single client connection
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.codec = FrameCodec()
+        self.channels = {}
+        self.outgoing = ''
+        self.pending = []
+        self.greeted = False
+        self.peer_window = DEFAULT_WINDOW
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def queue(self, frames):
+        self.pending.extend(frames)
+
+    def flush(self):
+        # All frames queued during one poll are packed together, this
+        # gives one compression flush point per poll: a keystroke echo goes
+        # out right away while bursts of data from many lines are batched
+        if self.pending:
+            self.outgoing += self.codec.pack(self.pending)
+            del self.pending[:]
+
+
+class MultiplexServer(object):
+    """
+    Server exposing local serial lines over the multiplexed protocol
+
+    Only the devices given in the constructor can be opened by clients.
+    Each device is opened as a :class:`DirectSerialLine` so the usual
+    exclusive locking applies.
+
+    Compression is used with clients that ask for it unless compression is
+    False. The optional disconnect_callback is called with the client
+    address and the :class:`TransportStats` of each closed connection.
+
+    With share, data received from each open line is also copied to its
+    shared memory ring (see :mod:`lava.serial.ring`).
+
+    With a :class:`lava.serial.trace.Tracer` the server records a span for
+    each serial read, socket receive and socket send.
+    """
+
+    def __init__(self, address, devices, window=DEFAULT_WINDOW,
+                 compression=True, disconnect_callback=None, share=False,
+                 tracer=None):
+        self.address = address
+        self.devices = frozenset(devices)
+        self.window = window
+        self.compression = compression
+        self.disconnect_callback = disconnect_callback
+        self.share = share
+        self.tracer = tracer
+        self.alive = False
+        self._listener = None
+        self._connections = {}
+
+    def bind(self):
+        """
+        Create the listening socket
+        """
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        self._listener.listen(16)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Serve clients until stop() is called
+        """
+        if self._listener is None:
+            self.bind()
+        self.alive = True
+        while self.alive:
+            self._poll(poll_interval)
+
+    def stop(self):
+        self.alive = False
+
+    def close(self):
+        """
+        Disconnect all clients, close all serial lines and the listener
+        """
+        for conn in self._connections.values():
+            self._drop_connection(conn)
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _poll(self, timeout):
+        rlist = [self._listener]
+        wlist = []
+        for conn in self._connections.itervalues():
+            rlist.append(conn)
+            if conn.outgoing:
+                wlist.append(conn)
+            for chan in conn.channels.itervalues():
+                # Lines without credit are not read at all, the data stays
+                # in the kernel buffer (and flow control kicks in) until the
+                # client catches up
+                if chan.send_credit > 0:
+                    rlist.append(chan)
+                if chan.outgoing:
+                    wlist.append(chan)
+        readable, writable = poll(rlist, wlist, timeout)
+        # tracing is off unless a tracer was given, keep the checks cheap
+        tracer = self.tracer
+        for obj in readable:
+            if tracer is not None:
+                start = time.time()
+            if obj is self._listener:
+                self._accept()
+                if tracer is not None:
+                    tracer.record("accept", start, time.time())
+            elif isinstance(obj, _ServerConnection):
+                self._recv(obj)
+                if tracer is not None:
+                    tracer.record("recv", start, time.time())
+            else:
+                self._read_serial(obj)
+                if tracer is not None:
+                    tracer.record("read", start, time.time())
+        for obj in writable:
+            # Sockets are written below, once all frames of this poll are
+            # queued
+            if isinstance(obj, _ServerChannel):
+                if tracer is not None:
+                    start = time.time()
+                self._write_serial(obj)
+                if tracer is not None:
+                    tracer.record("write", start, time.time())
+        for conn in self._connections.values():
+            if tracer is not None:
+                start = time.time()
+            conn.flush()
+            if conn.outgoing:
+                self._send(conn)
+            if tracer is not None:
+                tracer.record("send", start, time.time())
+
+    def _accept(self):
+        sock, address = self._listener.accept()
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connections[sock] = _ServerConnection(sock, address)
+
+    def _drop_connection(self, conn):
+        for chan in conn.channels.values():
+            chan.serial.close()
+        conn.channels.clear()
+        conn.sock.close()
+        if self._connections.pop(conn.sock, None) is not None:
+            if self.disconnect_callback is not None:
+                self.disconnect_callback(conn.address, conn.codec.stats)
+
+    def _recv(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._drop_connection(conn)
+            return
+        try:
+            frames = conn.codec.unpack(data)
+            while frames:
+                for frame_type, channel, payload in frames:
+                    self._handle_frame(conn, frame_type, channel, payload)
+                frames = conn.codec.unpack('')
+        except Exception:
+            # Protocol errors are the expected case but whatever a single
+            # client sends must never stop the server for everyone else
+            self._drop_connection(conn)
+
+    def _send(self, conn):
+        try:
+            sent = conn.sock.send(conn.outgoing)
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self._drop_connection(conn)
+            return
+        conn.outgoing = conn.outgoing[sent:]
+
+    def _handle_frame(self, conn, frame_type, channel, payload):
+        if not conn.greeted:
+            hello, conn.peer_window = _parse_hello(frame_type, payload)
+            conn.greeted = True
+            offered = hello.get("compression")
+            if offered is None:
+                offered = []
+            elif not isinstance(offered, list):
+                raise ProtocolError("malformed HELLO frame")
+            if self.compression and COMPRESSION_ZLIB in offered:
+                compression = COMPRESSION_ZLIB
+            else:
+                compression = None
+            # Our HELLO is the last uncompressed frame
+            conn.queue([(
+                FRAME_HELLO, 0, _hello_payload(self.window, compression))])
+            conn.flush()
+            if compression is not None:
+                conn.codec.start_compression(compression)
+            return
+        if frame_type == FRAME_OPEN:
+            self._open_channel(conn, channel, payload)
+            return
+        chan = conn.channels.get(channel)
+        if chan is None:
+            # The channel may have been closed by us in the meantime
+            return
+        if frame_type == FRAME_DATA:
+            if len(chan.outgoing) + len(payload) > self.window:
+                raise ProtocolError("flow control window exceeded")
+            chan.outgoing += payload
+            self._write_serial(chan)
+        elif frame_type == FRAME_WINDOW:
+            chan.send_credit += WINDOW_UPDATE.unpack(payload)[0]
+        elif frame_type == FRAME_CONTROL:
+            try:
+                apply_control(chan.serial, json.loads(payload))
+            except (ValueError, TypeError, AttributeError, EnvironmentError,
+                    pyserial.SerialException) as exc:
+                # Not all devices support all controls (for example
+                # pseudo-terminals have no modem lines), keep the channel
+                # open and let the client know
+                reply = {"error": str(exc)}
+            else:
+                reply = {}
+            conn.queue([(FRAME_CONTROL, channel, json.dumps(reply))])
+        elif frame_type == FRAME_CLOSE:
+            self._close_channel(conn, chan)
+        else:
+            raise ProtocolError("unexpected frame type %d" % frame_type)
+
+    def _open_channel(self, conn, channel, payload):
+        if channel in conn.channels:
+            conn.queue([(FRAME_ERROR, channel, "channel is already open")])
+            return
+        try:
+            settings = json.loads(payload)
+            port = settings.pop("port")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise ProtocolError("malformed OPEN frame")
+        if not isinstance(port, basestring):
+            raise ProtocolError("malformed OPEN frame")
+        if port not in self.devices:
+            conn.queue([(
+                FRAME_ERROR, channel,
+                "serial line %s is not exported" % port)])
+            return
+        kwargs = dict(
+            (str(key), value) for key, value in settings.iteritems()
+            if key in CONTROL_SETTINGS)
+        try:
+            serial = DirectSerialLine(port=port, timeout=0, **kwargs)
+        except (ValueError, pyserial.SerialException) as exc:
+            conn.queue([(FRAME_ERROR, channel, str(exc))])
+            return
+        # A device that does not take data must never block the server,
+        # see _write_serial()
+        flags = fcntl.fcntl(serial.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(serial.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if self.share:
+            try:
+                serial.start_sharing(default_ring_path(port))
+            except EnvironmentError as exc:
+                serial.close()
+                conn.queue([(FRAME_ERROR, channel, str(exc))])
+                return
+        conn.channels[channel] = _ServerChannel(
+            conn, channel, serial, conn.peer_window)
+        conn.queue([(FRAME_OPENED, channel, '')])
+
+    def _close_channel(self, conn, chan, error=None):
+        chan.serial.close()
+        del conn.channels[chan.channel]
+        if error is None:
+            conn.queue([(FRAME_CLOSE, chan.channel, '')])
+        else:
+            conn.queue([(FRAME_ERROR, chan.channel, error)])
+
+    def _write_serial(self, chan):
+        """
+        Write as much queued data as the device takes without blocking
+
+        The client gets window credit back only for the bytes that reached
+        the device, a line that is not taking input will eventually stop its
+        sender without affecting any other line.
+        """
+        conn = chan.conn
+        if conn.channels.get(chan.channel) is not chan:
+            # Closed earlier during this poll
+            return
+        try:
+            written = os.write(chan.fileno(), chan.outgoing)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._close_channel(conn, chan, str(exc))
+            return
+        chan.outgoing = chan.outgoing[written:]
+        if written:
+            conn.queue([(
+                FRAME_WINDOW, chan.channel, WINDOW_UPDATE.pack(written))])
+
+    def _read_serial(self, chan):
+        conn = chan.conn
+        if conn.channels.get(chan.channel) is not chan:
+            # Closed earlier during this poll
+            return
+        try:
+            size = max(1, min(
+                chan.serial.inWaiting(), chan.send_credit, MAX_CHUNK))
+            data = chan.serial.read_available(size)
+        except (EnvironmentError, pyserial.SerialException) as exc:
+            self._close_channel(conn, chan, str(exc))
+            return
+        if data:
+            chan.send_credit -= len(data)
+            conn.queue([(FRAME_DATA, chan.channel, data)])
+
+
+class MultiplexChannel(object):
+    """
+    Client side of a single serial line carried over a multiplexed connection
+
+    The object mimics the subset of the pyserial API that :class:`Miniterm`
+    uses so it can be used anywhere a local serial line is expected.
+    """
+
+    def __init__(self, client, channel, port, settings):
+        self._client = client
+        self._channel = channel
+        self._cond = threading.Condition()
+        self._buffer = ''
+        self._consumed = 0
+        self._send_credit = client.peer_window
+        self._opened = False
+        self._closed = False
+        self._error = None
+        # Serializes CONTROL frames so that each answer matches its request
+        self._control_lock = threading.Lock()
+        self._control_reply = None
+        self._settings = dict(
+            baudrate=115200, bytesize=pyserial.EIGHTBITS,
+            parity=pyserial.PARITY_NONE, stopbits=pyserial.STOPBITS_ONE,
+            xonxoff=False, rtscts=False)
+        self._settings.update(settings)
+        self.port = port
+        self.portstr = "%s:%d%s" % (client.address[0], client.address[1], port)
+        self.timeout = None
+        self.writeTimeout = None
+
+    def setTimeout(self, timeout):
+        self.timeout = timeout
+
+    def setWriteTimeout(self, timeout):
+        self.writeTimeout = timeout
+
+    def _make_setting(name):
+        def getter(self):
+            return self._settings[name]
+
+        def setter(self, value):
+            # Raises if the server rejected the value, so only values that
+            # were applied end up here
+            self._control({name: value})
+            self._settings[name] = value
+        return property(getter, setter)
+
+    baudrate = _make_setting('baudrate')
+    bytesize = _make_setting('bytesize')
+    parity = _make_setting('parity')
+    stopbits = _make_setting('stopbits')
+    xonxoff = _make_setting('xonxoff')
+    rtscts = _make_setting('rtscts')
+
+    del _make_setting
+
+    def setDTR(self, level=True):
+        self._control({'dtr': bool(level)})
+
+    def setRTS(self, level=True):
+        self._control({'rts': bool(level)})
+
+    def setBreak(self, level=True):
+        self._control({'break': bool(level)})
+
+    def _modem_lines_unavailable(self):
+        raise pyserial.SerialException(
+            "modem lines are not available on multiplexed serial lines")
+
+    getCTS = getDSR = getRI = getCD = _modem_lines_unavailable
+
+    def _control(self, control):
+        """
+        Change port settings, raises SerialException if the server could not
+        apply them
+        """
+        with self._control_lock:
+            with self._cond:
+                self._check_usable()
+                self._control_reply = None
+            self._client._send([
+                (FRAME_CONTROL, self._channel, json.dumps(control))])
+            with self._cond:
+                deadline = time.time() + self._client.timeout
+                while self._control_reply is None:
+                    self._check_usable()
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise pyserial.SerialException(
+                            "timeout while changing settings of %s" % (
+                                self.portstr,))
+                    self._cond.wait(remaining)
+                error = self._control_reply.get("error")
+        if error is not None:
+            raise pyserial.SerialException(
+                "could not change settings of %s: %s" % (self.portstr, error))
+
+    def _check_usable(self):
+        if self._error is not None:
+            raise pyserial.SerialException(self._error)
+        if self._closed:
+            raise pyserial.portNotOpenError
+
+    def inWaiting(self):
+        with self._cond:
+            return len(self._buffer)
+
+    def read(self, size=1):
+        """
+        Read up to size bytes, waiting at most timeout seconds for them
+        """
+        # The receiver thread holds the lock while it appends data
+        acquire(self._cond, self._client.tracer, "wait channel lock")
+        try:
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while len(self._buffer) < size:
+                self._check_usable()
+                if self.timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            data = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            self._consumed += len(data)
+            # Grant more credit once half of the window was consumed
+            if self._consumed >= self._client.window // 2:
+                update, self._consumed = self._consumed, 0
+            else:
+                update = 0
+        finally:
+            self._cond.release()
+        if update:
+            self._client._send([(
+                FRAME_WINDOW, self._channel, WINDOW_UPDATE.pack(update))])
+        return data
+
+    def write(self, data):
+        """
+        Write data, waiting at most writeTimeout seconds for window credit
+        """
+        if self.writeTimeout is not None:
+            deadline = time.time() + self.writeTimeout
+        while data:
+            acquire(self._cond, self._client.tracer, "wait channel lock")
+            try:
+                while self._send_credit == 0:
+                    self._check_usable()
+                    if self.writeTimeout is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise pyserial.writeTimeoutError
+                        self._cond.wait(remaining)
+                self._check_usable()
+                size = min(self._send_credit, MAX_CHUNK, len(data))
+                self._send_credit -= size
+            finally:
+                self._cond.release()
+            self._client._send([(FRAME_DATA, self._channel, data[:size])])
+            data = data[size:]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._client._forget(self._channel)
+        if self._error is None and self._client.connected:
+            self._client._send([(FRAME_CLOSE, self._channel, '')])
+
+    def _on_frame(self, frame_type, payload):
+        with self._cond:
+            if frame_type == FRAME_DATA:
+                self._buffer += payload
+            elif frame_type == FRAME_WINDOW:
+                self._send_credit += WINDOW_UPDATE.unpack(payload)[0]
+            elif frame_type == FRAME_CONTROL:
+                try:
+                    reply = json.loads(payload)
+                except ValueError:
+                    reply = None
+                if not isinstance(reply, dict):
+                    reply = {"error": "malformed CONTROL reply"}
+                self._control_reply = reply
+            elif frame_type == FRAME_OPENED:
+                self._opened = True
+            elif frame_type == FRAME_ERROR:
+                self._error = payload
+            elif frame_type == FRAME_CLOSE:
+                self._closed = True
+            self._cond.notify_all()
+
+    def _wait_open(self, timeout):
+        with self._cond:
+            deadline = time.time() + timeout
+            while not self._opened:
+                self._check_usable()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise pyserial.SerialException(
+                        "timeout while opening %s" % self.portstr)
+                self._cond.wait(remaining)
+
+
+class MultiplexClient(object):
+    """
+    Client of a :class:`MultiplexServer`
+
+    One client (and one TCP/IP connection) can open any number of serial
+    lines exported by the server with :meth:`open_line`.
+
+    With compression the client offers zlib compression to the server and
+    falls back to an uncompressed connection if the server declines.
+
+    With a :class:`lava.serial.trace.Tracer` the client records the time
+    threads spend waiting for the connection and channel locks.
+    """
+
+    def __init__(self, address, window=DEFAULT_WINDOW, timeout=10.0,
+                 compression=False, tracer=None):
+        self.address = address
+        self.window = window
+        self.timeout = timeout
+        self.compression = compression
+        self.tracer = tracer
+        self.peer_window = None
+        self.connected = False
+        self._sock = None
+        self._codec = FrameCodec()
+        self._send_lock = threading.Lock()
+        self._channels_lock = threading.Lock()
+        self._channels = {}
+        self._next_channel = 1
+        self._receiver_thread = None
+
+    def connect(self):
+        """
+        Connect to the server and exchange HELLO frames
+        """
+        self._sock = socket.create_connection(self.address, self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected = True
+        if self.compression:
+            offer = [COMPRESSION_ZLIB]
+        else:
+            offer = []
+        self._send([(FRAME_HELLO, 0, _hello_payload(self.window, offer))])
+        frames = []
+        while not frames:
+            data = self._sock.recv(65536)
+            if not data:
+                raise ProtocolError("connection closed during handshake")
+            frames = self._codec.unpack(data)
+        hello, self.peer_window = _parse_hello(*frames[0][0::2])
+        compression = hello.get("compression")
+        if compression is not None:
+            if compression not in offer:
+                raise ProtocolError(
+                    "server picked compression %r that was not offered" % (
+                        compression,))
+            self._codec.start_compression(compression)
+        frames = self._codec.unpack('')
+        self._sock.settimeout(None)
+        self._receiver_thread = threading.Thread(
+            target=self._receiver,
+            name="receiver for %s:%d" % self.address)
+        self._receiver_thread.daemon = True
+        self._receiver_thread.start()
+        for frame_type, channel, payload in frames:
+            self._dispatch(frame_type, channel, payload)
+
+    @property
+    def stats(self):
+        """
+        :class:`TransportStats` of this connection
+        """
+        return self._codec.stats
+
+    def open_line(self, port, **settings):
+        """
+        Open a serial line exported by the server
+
+        The keyword arguments are initial port settings, see
+        CONTROL_SETTINGS for the list of supported names.
+        """
+        with self._channels_lock:
+            for attempt in xrange(MAX_CHANNEL):
+                channel = self._next_channel
+                self._next_channel = self._next_channel % MAX_CHANNEL + 1
+                if channel not in self._channels:
+                    break
+            else:
+                raise pyserial.SerialException("too many open channels")
+            chan = MultiplexChannel(self, channel, port, settings)
+            self._channels[channel] = chan
+        settings = dict(settings, port=port)
+        self._send([(FRAME_OPEN, channel, json.dumps(settings))])
+        try:
+            chan._wait_open(self.timeout)
+        except:
+            self._forget(channel)
+            raise
+        return chan
+
+    def close(self):
+        """
+        Close all channels and the connection itself
+        """
+        with self._channels_lock:
+            channels = self._channels.values()
+        for chan in channels:
+            chan.close()
+        if self.connected:
+            self.connected = False
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+
+    def _forget(self, channel):
+        with self._channels_lock:
+            self._channels.pop(channel, None)
+
+    def _send(self, frames):
+        # Keystrokes and window updates from different threads share the
+        # connection
+        acquire(self._send_lock, self.tracer, "wait send lock")
+        try:
+            self._sock.sendall(self._codec.pack(frames))
+        except socket.error as exc:
+            raise pyserial.SerialException(
+                "connection to %s:%d lost: %s" % (
+                    self.address[0], self.address[1], exc))
+        finally:
+            self._send_lock.release()
+
+    def _dispatch(self, frame_type, channel, payload):
+        with self._channels_lock:
+            chan = self._channels.get(channel)
+        if chan is not None:
+            chan._on_frame(frame_type, payload)
+
+    def _receiver(self):
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                for frame_type, channel, payload in self._codec.unpack(data):
+                    self._dispatch(frame_type, channel, payload)
+        except socket.error:
+            pass
+        finally:
+            with self._channels_lock:
+                channels = self._channels.values()
+            for chan in channels:
+                chan._on_frame(FRAME_ERROR, "connection to %s:%d lost" % (
+                    self.address))
@@ -0,0 +1,73 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Waiting for many descriptors at once
+
+select.select() cannot handle descriptors above FD_SETSIZE (1024), which
+a service or load test with hundreds of serial lines easily reaches.
+"""
+
+import errno
+import select
+
+
+_ERRORS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+def _fileno(obj):
+    if isinstance(obj, (int, long)):
+        return obj
+    return obj.fileno()
+
+
+def poll(rlist, wlist, timeout=None):
+    """
+    Wait until objects in rlist are readable or objects in wlist writable
+
+    Works like select.select() without the exceptional list but is not
+    limited in the number or value of descriptors. Objects are descriptors
+    or anything with a fileno() method. Errors and hang-ups are reported as
+    readiness so that the following read or write can fail properly.
+    Returns a (readable, writable) tuple, empty if interrupted by a signal.
+    """
+    poller = select.poll()
+    masks = {}
+    for obj in rlist:
+        fd = _fileno(obj)
+        masks[fd] = masks.get(fd, 0) | select.POLLIN
+    for obj in wlist:
+        fd = _fileno(obj)
+        masks[fd] = masks.get(fd, 0) | select.POLLOUT
+    for fd, mask in masks.iteritems():
+        poller.register(fd, mask)
+    if timeout is not None:
+        timeout = int(timeout * 1000)
+    try:
+        events = dict(poller.poll(timeout))
+    except select.error as exc:
+        if exc.args[0] == errno.EINTR:
+            return [], []
+        raise
+    readable = [
+        obj for obj in rlist
+        if events.get(_fileno(obj), 0) & (select.POLLIN | _ERRORS)]
+    writable = [
+        obj for obj in wlist
+        if events.get(_fileno(obj), 0) & (select.POLLOUT | _ERRORS)]
+    return readable, writable
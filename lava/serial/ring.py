@@ -0,0 +1,270 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared memory ring buffer of received serial data
+
+The process that owns a serial line writes everything it receives into a
+memory mapped file (normally in /dev/shm). Any number of local processes
+can map the same file and follow the data with their own cursor.
+
+The file starts with a header followed by the data area::
+
+    +-------+---------+----------+----------+----------+--------+---------+
+    | magic | version | capacity | sequence | reserved | closed | padding |
+    | 8s    | u32     | u32      | u64      | u64      | u32    |         |
+    +-------+---------+----------+----------+----------+--------+---------+
+    | data (capacity)                                                     |
+    +---------------------------------------------------------------------+
+
+The sequence is the total number of bytes ever written. Byte number N is
+stored at offset N % capacity of the data area. Each write is published in
+three steps: the writer first bumps the reserved counter to the sequence
+the write will end at, then stores the data and finally sets the sequence
+to the same value. A reader copies the bytes below the sequence and then
+looks at the reserved counter: anything more than capacity bytes behind it
+may have been overwritten during the copy and is counted as lost, just
+like data the reader fell behind on before the copy.
+
+The closed flag is set by the writer when it stops writing. The file is
+replaced (never rewritten) when a new writer starts, readers notice that
+by comparing the inode of the path with the one they have mapped.
+"""
+
+import errno
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+
+RING_MAGIC = "LAVARING"
+RING_VERSION = 1
+RING_HEADER = struct.Struct("=8sIIQQI")
+# Offsets of the counters and the flag inside the header
+RING_COUNTER = struct.Struct("=Q")
+RING_SEQUENCE_OFFSET = 16
+RING_RESERVED_OFFSET = 24
+RING_FLAG = struct.Struct("=I")
+RING_CLOSED_OFFSET = 32
+# The data area starts at a cache line boundary
+RING_DATA_OFFSET = 64
+RING_DIR = "/dev/shm"
+DEFAULT_CAPACITY = 1024 * 1024
+# Serial traffic can contain passwords, only the owner can read it by default
+DEFAULT_MODE = 0600
+
+
+def default_ring_path(port):
+    """
+    Path of the ring file used for the specified serial device
+    """
+    return os.path.join(
+        RING_DIR, "lava-serial" + port.replace(os.sep, "-"))
+
+
+class RingError(Exception):
+    """
+    Exception raised for files that are not valid ring buffers
+    """
+
+
+class RingWriter(object):
+    """
+    Writing side of the ring, there should be only one per ring file
+
+    The file is created with the specified mode, pass a more permissive
+    mode to share the data with other users.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, mode=DEFAULT_MODE):
+        self.path = path
+        self.capacity = capacity
+        self.sequence = 0
+        # Create the ring under a temporary name so that readers never see
+        # a partially initialized file. RING_DIR is writable by everyone,
+        # mkstemp() picks a name nobody can guess and never opens an
+        # existing file or follows a symlink planted there.
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(path) + ".", dir=os.path.dirname(path))
+        try:
+            os.fchmod(fd, mode)
+            os.ftruncate(fd, RING_DATA_OFFSET + capacity)
+            self._map = mmap.mmap(fd, RING_DATA_OFFSET + capacity)
+        except:
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        os.close(fd)
+        RING_HEADER.pack_into(
+            self._map, 0, RING_MAGIC, RING_VERSION, capacity, 0, 0, 0)
+        os.rename(tmp_path, path)
+
+    def write(self, data):
+        """
+        Append data to the ring, overwriting the oldest data if needed
+        """
+        size = len(data)
+        # Let readers know which bytes are about to be overwritten
+        RING_COUNTER.pack_into(
+            self._map, RING_RESERVED_OFFSET, self.sequence + size)
+        if size > self.capacity:
+            data = data[-self.capacity:]
+        start = (self.sequence + size - len(data)) % self.capacity
+        head = min(len(data), self.capacity - start)
+        offset = RING_DATA_OFFSET + start
+        self._map[offset:offset + head] = data[:head]
+        if head < len(data):
+            self._map[RING_DATA_OFFSET:
+                      RING_DATA_OFFSET + len(data) - head] = data[head:]
+        self.sequence += size
+        RING_COUNTER.pack_into(self._map, RING_SEQUENCE_OFFSET, self.sequence)
+
+    def close(self, unlink=True):
+        """
+        Unmap the ring and (by default) remove the file
+
+        Readers that still have the ring mapped can read what is left and
+        see that the ring is closed.
+        """
+        RING_FLAG.pack_into(self._map, RING_CLOSED_OFFSET, 1)
+        self._map.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class RingReader(object):
+    """
+    Reading side of the ring
+
+    Each reader has its own cursor. By default reading starts with the
+    data written after the reader was created, pass from_start=True to
+    start with the oldest data still in the ring.
+    """
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            size = stat.st_size
+            self._identity = (stat.st_dev, stat.st_ino)
+            if size < RING_DATA_OFFSET:
+                raise RingError("%s is too short to be a ring" % path)
+            self._map = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, self.capacity, sequence, _, _ = (
+            RING_HEADER.unpack_from(self._map, 0))
+        if magic != RING_MAGIC or version != RING_VERSION:
+            self._map.close()
+            raise RingError("%s is not a ring" % path)
+        if from_start:
+            self.cursor = max(0, sequence - self.capacity)
+        else:
+            self.cursor = sequence
+        # Total number of bytes lost because of overruns
+        self.lost = 0
+
+    @property
+    def sequence(self):
+        return RING_COUNTER.unpack_from(self._map, RING_SEQUENCE_OFFSET)[0]
+
+    @property
+    def reserved(self):
+        return RING_COUNTER.unpack_from(self._map, RING_RESERVED_OFFSET)[0]
+
+    @property
+    def closed(self):
+        """
+        True once the writer has closed the ring
+        """
+        return RING_FLAG.unpack_from(self._map, RING_CLOSED_OFFSET)[0] != 0
+
+    @property
+    def replaced(self):
+        """
+        True if the path no longer refers to the ring mapped by this reader
+        (the ring was removed or a new writer created a new one)
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return True
+            raise
+        return (stat.st_dev, stat.st_ino) != self._identity
+
+    def read(self, size=None):
+        """
+        Read at most size bytes of new data
+
+        Returns a (data, lost) tuple where lost is the number of bytes
+        that were overwritten before this reader could see them.
+        """
+        sequence = self.sequence
+        lost = 0
+        if sequence - self.cursor > self.capacity:
+            lost = sequence - self.capacity - self.cursor
+            self.cursor = sequence - self.capacity
+        end = sequence
+        if size is not None:
+            end = min(end, self.cursor + size)
+        start = self.cursor % self.capacity
+        count = end - self.cursor
+        head = min(count, self.capacity - start)
+        offset = RING_DATA_OFFSET + start
+        data = self._map[offset:offset + head]
+        if head < count:
+            data += self._map[RING_DATA_OFFSET:RING_DATA_OFFSET + count - head]
+        # The writer could have lapped us while we were copying, whatever it
+        # reserved (and so may have overwritten already) is lost as well
+        overwritten = self.reserved - self.capacity - self.cursor
+        if overwritten > 0:
+            data = data[overwritten:]
+            lost += min(overwritten, count)
+        self.cursor = end
+        self.lost += lost
+        return data, lost
+
+    def follow(self, interval=0.05):
+        """
+        Generate (data, lost) tuples as new data shows up in the ring
+
+        The generator ends once the writer closed the ring or the ring was
+        replaced by a new one, and everything left in it was read.
+        """
+        while True:
+            data, lost = self.read()
+            if data or lost:
+                yield data, lost
+            elif self.closed or self.replaced:
+                # The writer might have written a last bit before closing
+                data, lost = self.read()
+                if data or lost:
+                    yield data, lost
+                return
+            else:
+                time.sleep(interval)
+
+    def close(self):
+        self._map.close()
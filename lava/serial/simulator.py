@@ -0,0 +1,383 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Simulated boards for load-testing the serial stack
+
+Each simulated board is a pseudo-terminal. The board writes a boot log to
+the master side at a pace matching the configured baud rate and answers
+simple commands typed at its prompt. The slave side path can be used
+anywhere a serial device path is accepted.
+
+Like a real UART without flow control, a board never waits for a slow
+reader: whatever does not fit in the pseudo-terminal buffer is dropped and
+counted.
+"""
+
+import collections
+import errno
+import fcntl
+import itertools
+import os
+import pty
+import random
+import threading
+import time
+import tty
+
+import serial as pyserial
+
+from lava.serial.direct import DirectSerialLine
+from lava.serial.poll import poll
+
+
+# Number of recent writes remembered for latency measurements
+TIMELINE_LENGTH = 100000
+DEFAULT_PROMPT = "root@board:~# "
+DEFAULT_RESPONSES = {
+    "uname -a": "Linux board 3.0.0 #1 SMP PREEMPT armv7l GNU/Linux\r\n",
+    "uptime": " 00:01:02 up 1 min,  1 user,  load average: 0.00\r\n",
+}
+
+
+def synthetic_boot_log(count=2000):
+    """
+    Generate a kernel-like boot log with count lines
+    """
+    messages = (
+        "Booting Linux on physical CPU 0",
+        "Memory policy: ECC disabled, Data cache writeback",
+        "CPU: ARMv7 Processor [412fc09a] revision 10 (ARMv7), cr=10c53c7d",
+        "Kernel command line: console=ttyO2,115200n8 root=/dev/mmcblk0p2 rw",
+        "mmc0: new high speed SDHC card at address e624",
+        "EXT4-fs (mmcblk0p2): mounted filesystem with ordered data mode",
+        "usb 1-1: new high speed USB device number 2 using ehci-omap",
+        "smsc95xx v1.0.4: eth0: register 'smsc95xx' at usb-ehci-omap.0-1.1",
+    )
+    return [
+        "[%5d.%06d] %s\r\n" % (
+            index // 100, (index % 100) * 10000,
+            messages[index % len(messages)])
+        for index in xrange(count)]
+
+
+def load_boot_log(path):
+    """
+    Load a recorded boot log, line by line
+    """
+    with open(path, "rb") as stream:
+        return stream.readlines()
+
+
+class SimulatedBoard(object):
+    """
+    A pseudo-terminal that behaves like a booting board
+
+    The boot log is replayed at the pace of the specified baud rate (8N1,
+    that is ten bits per byte). Every now and then the board emits a burst
+    of burst_lines lines without any pacing (with burst_chance probability
+    per line) or goes idle for idle_time seconds (with idle_chance
+    probability per line). After the log the board shows a prompt and
+    answers commands from responses. With repeat the log is replayed
+    again and again. The log must not be empty.
+    """
+
+    def __init__(self, log, baudrate=115200, repeat=True,
+                 prompt=DEFAULT_PROMPT, responses=DEFAULT_RESPONSES,
+                 burst_chance=0.0, burst_lines=50,
+                 idle_chance=0.0, idle_time=1.0, seed=None):
+        if not log:
+            # Nothing would pace the replay, see _run()
+            raise ValueError("the boot log is empty")
+        self.log = log
+        self.baudrate = baudrate
+        self.repeat = repeat
+        self.prompt = prompt
+        self.responses = responses
+        self.burst_chance = burst_chance
+        self.burst_lines = burst_lines
+        self.idle_chance = idle_chance
+        self.idle_time = idle_time
+        self.seed = seed
+        # Number of bytes that made it to the pseudo-terminal
+        self.written = 0
+        # Number of bytes dropped because nobody was reading fast enough
+        self.dropped = 0
+        # (written, timestamp) pairs recorded after each write, used to
+        # measure latency
+        self.timeline = collections.deque(maxlen=TIMELINE_LENGTH)
+        self.alive = False
+        self._command = ''
+        self.master, self._slave = pty.openpty()
+        # The slave stays open so that the path stays valid and does not
+        # hang up when readers come and go
+        tty.setraw(self._slave)
+        flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.path = os.ttyname(self._slave)
+        self._thread = None
+
+    def start(self):
+        self.alive = True
+        self._thread = threading.Thread(
+            target=self._run,
+            name="simulated board on %s" % self.path)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.alive = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _emit(self, data):
+        try:
+            count = os.write(self.master, data)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            count = 0
+        self.dropped += len(data) - count
+        if count:
+            self.written += count
+            self.timeline.append((self.written, time.time()))
+
+    def _wait(self, deadline):
+        """
+        Answer input until the deadline
+        """
+        while self.alive:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # Wake up now and then to notice stop()
+            readable, _ = poll([self.master], [], min(remaining, 0.5))
+            if readable:
+                self._handle_input(os.read(self.master, 1024))
+
+    def _handle_input(self, data):
+        for character in data:
+            if character in '\r\n':
+                command, self._command = self._command.strip(), ''
+                if command:
+                    response = self.responses.get(
+                        command, "sh: %s: not found\r\n" % command)
+                else:
+                    response = ''
+                self._emit("\r\n" + response + self.prompt)
+            else:
+                self._command += character
+                self._emit(character)
+
+    def _run(self):
+        rng = random.Random(self.seed)
+        next_time = time.time()
+        while self.alive:
+            lines = iter(self.log)
+            for line in lines:
+                if not self.alive:
+                    return
+                if rng.random() < self.idle_chance:
+                    next_time += self.idle_time
+                self._wait(next_time)
+                if rng.random() < self.burst_chance:
+                    # Burst, as fast as the pseudo-terminal lets us
+                    self._emit(line)
+                    for line in itertools.islice(lines, self.burst_lines - 1):
+                        self._emit(line)
+                    next_time = time.time()
+                else:
+                    self._emit(line)
+                    next_time += len(line) * 10.0 / self.baudrate
+            self._emit(self.prompt)
+            next_time += len(self.prompt) * 10.0 / self.baudrate
+            if not self.repeat:
+                break
+        self._wait(float("inf"))
+
+
+class BoardFarm(object):
+    """
+    A collection of simulated boards, see :class:`SimulatedBoard`
+    """
+
+    def __init__(self, count, log, **kwargs):
+        seed = kwargs.pop("seed", None)
+        self.boards = []
+        try:
+            for index in xrange(count):
+                if seed is not None:
+                    kwargs["seed"] = seed + index
+                self.boards.append(SimulatedBoard(log, **kwargs))
+        except:
+            self.close()
+            raise
+
+    @property
+    def paths(self):
+        return [board.path for board in self.boards]
+
+    def start(self):
+        for board in self.boards:
+            board.start()
+
+    def stop(self):
+        for board in self.boards:
+            board.alive = False
+        for board in self.boards:
+            board.stop()
+
+    def close(self):
+        self.stop()
+        for board in self.boards:
+            board.close()
+
+
+class LoadReport(object):
+    """
+    Aggregate results of a :class:`LoadDriver` run
+    """
+
+    def __init__(self, lines, duration, received, dropped, latencies):
+        self.lines = lines
+        self.duration = duration
+        self.received = received
+        self.dropped = dropped
+        self.latencies = sorted(latencies)
+
+    @property
+    def throughput(self):
+        """
+        Aggregate throughput in bytes per second
+        """
+        if self.duration <= 0:
+            return 0.0
+        return self.received / self.duration
+
+    @property
+    def line_throughput(self):
+        """
+        Average throughput of a single line in bytes per second
+        """
+        if not self.lines:
+            return 0.0
+        return self.throughput / self.lines
+
+    def latency(self, fraction):
+        """
+        Latency (in seconds) below which the specified fraction of samples
+        fall, None without samples
+        """
+        if not self.latencies:
+            return None
+        index = min(len(self.latencies) - 1,
+                    int(len(self.latencies) * fraction))
+        return self.latencies[index]
+
+    def __str__(self):
+        text = (
+            "lines: %d\n"
+            "duration: %.2fs\n"
+            "received: %d bytes\n"
+            "throughput: %.0f bytes/s (%.0f bytes/s per line)\n"
+            "dropped: %d bytes\n") % (
+                self.lines, self.duration, self.received,
+                self.throughput, self.line_throughput,
+                self.dropped)
+        if self.latencies:
+            text += (
+                "latency: min %.2fms, median %.2fms, 99%% %.2fms,"
+                " max %.2fms\n") % (
+                    self.latencies[0] * 1000,
+                    self.latency(0.5) * 1000,
+                    self.latency(0.99) * 1000,
+                    self.latencies[-1] * 1000)
+        return text
+
+
+class LoadDriver(object):
+    """
+    Read all lines of a board farm and measure throughput, drops and latency
+
+    Each line is opened as a :class:`DirectSerialLine`, just like the
+    console and the service would do. Latency is the time between a board
+    writing data and the driver reading it.
+    """
+
+    def __init__(self, farm, baudrate=115200):
+        self.farm = farm
+        self.baudrate = baudrate
+
+    def run(self, duration, drain_time=0.5):
+        lines = []
+        try:
+            for board in self.farm.boards:
+                lines.append(DirectSerialLine(
+                    port=board.path, baudrate=self.baudrate, timeout=0))
+            received = dict((line, 0) for line in lines)
+            latencies = []
+            boards = dict(zip(lines, self.farm.boards))
+            start = time.time()
+            self.farm.start()
+            active = list(lines)
+            self._pump(active, boards, received, latencies, start + duration)
+            # The boards stop writing now, the drain below only picks up
+            # what they wrote so far and does not count as test time
+            elapsed = time.time() - start
+            self.farm.stop()
+            # Pick up whatever is still in flight
+            self._pump(active, boards, received, latencies,
+                       time.time() + drain_time)
+        finally:
+            self.farm.stop()
+            for line in lines:
+                line.close()
+        dropped = sum(
+            board.dropped + board.written - received[line]
+            for line, board in boards.iteritems())
+        return LoadReport(
+            len(lines), elapsed, sum(received.itervalues()), dropped,
+            latencies)
+
+    def _pump(self, lines, boards, received, latencies, deadline):
+        """
+        Read the lines until the deadline, lines that fail are removed
+        """
+        while lines:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # Farms easily go past the descriptor limit of select()
+            readable, _ = poll(lines, [], remaining)
+            for line in readable:
+                try:
+                    data = line.read_available(4096)
+                except pyserial.SerialException:
+                    lines.remove(line)
+                    continue
+                now = time.time()
+                received[line] += len(data)
+                timeline = boards[line].timeline
+                while timeline and timeline[0][0] <= received[line]:
+                    latencies.append(now - timeline.popleft()[1])
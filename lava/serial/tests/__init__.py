@@ -0,0 +1,37 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for LAVA Serial
+
+Everything here runs without serial hardware, pseudo-terminals, pipes and
+loopback sockets stand in for real lines.
+"""
+
+import unittest
+
+
+def test_suite():
+    module_names = [
+        'lava.serial.tests.test_miniterm',
+        'lava.serial.tests.test_mux',
+        'lava.serial.tests.test_ring',
+        'lava.serial.tests.test_simulator',
+    ]
+    loader = unittest.TestLoader()
+    return loader.loadTestsFromNames(module_names)
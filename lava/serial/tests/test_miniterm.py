@@ -0,0 +1,107 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import unittest
+
+from lava.serial.miniterm import (
+    CONVERT_CR,
+    CONVERT_CRLF,
+    CONVERT_LF,
+    Miniterm,
+    TIMESTAMP_RELATIVE,
+)
+
+
+def render_bytewise(repr_mode, convert_outgoing, data):
+    """
+    Render data the way Miniterm used to, one received byte at a time
+    """
+    output = []
+    for char in data:
+        if repr_mode == 0:
+            if char == '\r' and convert_outgoing == CONVERT_CR:
+                output.append('\n')
+            else:
+                output.append(char)
+        elif repr_mode == 1:
+            if convert_outgoing == CONVERT_CRLF and char in '\r\n':
+                if char == '\n':
+                    output.append('\n')
+            elif char == '\n' and convert_outgoing == CONVERT_LF:
+                output.append('\n')
+            elif char == '\r' and convert_outgoing == CONVERT_CR:
+                output.append('\n')
+            else:
+                output.append(repr(char)[1:-1])
+        elif repr_mode == 2:
+            output.append(repr(char)[1:-1])
+        elif repr_mode == 3:
+            output.append("%s " % char.encode('hex'))
+    return ''.join(output)
+
+
+class RenderTests(unittest.TestCase):
+
+    def test_matches_bytewise_rendering(self):
+        rng = random.Random(0)
+        alphabet = '\r\n\'"\\ab\x00\x7f\xff\t '
+        for trial in xrange(500):
+            data = ''.join(
+                rng.choice(alphabet) for i in xrange(rng.randint(0, 20)))
+            for repr_mode in range(4):
+                for convert in (CONVERT_LF, CONVERT_CR, CONVERT_CRLF):
+                    term = Miniterm(
+                        None, None, repr_mode=repr_mode,
+                        convert_outgoing=convert)
+                    self.assertEqual(
+                        term._render(data),
+                        render_bytewise(repr_mode, convert, data),
+                        (data, repr_mode, convert))
+
+
+class TimestampTests(unittest.TestCase):
+
+    chunks = [
+        ("line1\r\nli", 101.0), ("ne2\r\n", 101.5), ("line3\r\n", 102.25)]
+
+    def render(self, repr_mode):
+        term = Miniterm(
+            None, None, repr_mode=repr_mode, timestamps=TIMESTAMP_RELATIVE,
+            timestamp_delta=True)
+        term.started = 100.0
+        return ''.join([
+            term._render_timestamped(data, now) for data, now in self.chunks])
+
+    def test_raw(self):
+        self.assertEqual(self.render(0), (
+            "[   1.000000 +0.000000] line1\r\n"
+            "[   1.000000 +0.000000] line2\r\n"
+            "[   2.250000 +1.250000] line3\r\n"))
+
+    def test_all_control(self):
+        self.assertEqual(self.render(2), (
+            "[   1.000000 +0.000000] line1\\r\\n\n"
+            "[   1.000000 +0.000000] line2\\r\\n\n"
+            "[   2.250000 +1.250000] line3\\r\\n\n"))
+
+    def test_hex(self):
+        self.assertEqual(self.render(3), (
+            "[   1.000000 +0.000000] 6c 69 6e 65 31 0d 0a \n"
+            "[   1.000000 +0.000000] 6c 69 6e 65 32 0d 0a \n"
+            "[   2.250000 +1.250000] 6c 69 6e 65 33 0d 0a \n"))
@@ -0,0 +1,288 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import json
+import os
+import pty
+import socket
+import threading
+import tty
+import unittest
+
+import serial as pyserial
+
+from lava.serial.mux import (
+    COMPRESSION_ZLIB,
+    FRAME_DATA,
+    FRAME_HELLO,
+    FRAME_OPEN,
+    FRAME_WINDOW,
+    FrameCodec,
+    MultiplexClient,
+    MultiplexServer,
+    ProtocolError,
+    WINDOW_UPDATE,
+    _ServerChannel,
+    _ServerConnection,
+    _hello_payload,
+)
+
+
+FRAMES = [
+    (FRAME_HELLO, 0, _hello_payload(1024, None)),
+    (FRAME_DATA, 1, "hello"),
+    (FRAME_DATA, 2, ""),
+    (FRAME_WINDOW, 1, WINDOW_UPDATE.pack(5)),
+    (FRAME_DATA, 65535, "x" * 4096),
+]
+
+
+class FrameCodecTests(unittest.TestCase):
+
+    def unpack_all(self, codec, data):
+        frames = codec.unpack(data)
+        while True:
+            more = codec.unpack('')
+            if not more:
+                return frames
+            frames.extend(more)
+
+    def test_round_trip(self):
+        data = FrameCodec().pack(FRAMES)
+        self.assertEqual(self.unpack_all(FrameCodec(), data), FRAMES)
+
+    def test_round_trip_byte_by_byte(self):
+        data = FrameCodec().pack(FRAMES)
+        codec = FrameCodec()
+        frames = []
+        for char in data:
+            frames.extend(self.unpack_all(codec, char))
+        self.assertEqual(frames, FRAMES)
+
+    def test_unpack_stops_after_hello(self):
+        data = FrameCodec().pack(FRAMES)
+        codec = FrameCodec()
+        self.assertEqual(codec.unpack(data), FRAMES[:1])
+        self.assertEqual(codec.unpack(''), FRAMES[1:])
+
+    def test_compressed_round_trip(self):
+        sender, receiver = FrameCodec(), FrameCodec()
+        sender.start_compression(COMPRESSION_ZLIB)
+        receiver.start_compression(COMPRESSION_ZLIB)
+        log = "[    0.000000] Booting Linux on physical CPU 0\r\n" * 50
+        frames = [(FRAME_DATA, 1, log), (FRAME_DATA, 1, log)]
+        # Each pack() is flushed, the peer can decode it right away
+        for frame in frames:
+            self.assertEqual(
+                self.unpack_all(receiver, sender.pack([frame])), [frame])
+        self.assertEqual(sender.stats.compression, COMPRESSION_ZLIB)
+        self.assertTrue(sender.stats.wire_sent < sender.stats.payload_sent)
+        self.assertEqual(
+            receiver.stats.payload_received, sender.stats.payload_sent)
+
+    def test_compression_after_hello(self):
+        # Compressed data can arrive together with the HELLO frame
+        sender, receiver = FrameCodec(), FrameCodec()
+        data = sender.pack(FRAMES[:1])
+        sender.start_compression(COMPRESSION_ZLIB)
+        data += sender.pack(FRAMES[1:])
+        self.assertEqual(receiver.unpack(data), FRAMES[:1])
+        receiver.start_compression(COMPRESSION_ZLIB)
+        self.assertEqual(self.unpack_all(receiver, ''), FRAMES[1:])
+
+    def test_corrupted_stream(self):
+        codec = FrameCodec()
+        codec.start_compression(COMPRESSION_ZLIB)
+        self.assertRaises(ProtocolError, codec.unpack, "not zlib")
+
+    def test_unsupported_compression(self):
+        self.assertRaises(
+            ProtocolError, FrameCodec().start_compression, "lzma")
+
+
+class _Pipe(object):
+    """
+    Serial line stand-in that writes to a pipe
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.write_fd
+
+    def fill(self):
+        while True:
+            try:
+                os.write(self.write_fd, "x" * 4096)
+            except OSError as exc:
+                if exc.errno == errno.EAGAIN:
+                    return
+                raise
+
+    def drain(self):
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        while True:
+            try:
+                os.read(self.read_fd, 65536)
+            except OSError as exc:
+                if exc.errno == errno.EAGAIN:
+                    return
+                raise
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class ServerWindowTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MultiplexServer(('127.0.0.1', 0), [], window=16)
+        self.conn = _ServerConnection(None, None)
+        self.conn.greeted = True
+        self.line = _Pipe()
+        self.chan = _ServerChannel(self.conn, 1, self.line, 16)
+        self.conn.channels[1] = self.chan
+
+    def tearDown(self):
+        self.line.close()
+
+    def data(self, payload):
+        self.server._handle_frame(self.conn, FRAME_DATA, 1, payload)
+
+    def window_updates(self):
+        updates = [
+            WINDOW_UPDATE.unpack(payload)[0]
+            for frame_type, channel, payload in self.conn.pending
+            if frame_type == FRAME_WINDOW]
+        del self.conn.pending[:]
+        return updates
+
+    def test_credit_for_written_data(self):
+        self.data("hello")
+        self.assertEqual(self.window_updates(), [5])
+        self.assertEqual(self.chan.outgoing, '')
+
+    def test_no_credit_while_device_is_stuck(self):
+        self.line.fill()
+        self.data("x" * 10)
+        self.assertEqual(self.window_updates(), [])
+        self.assertEqual(self.chan.outgoing, "x" * 10)
+        self.line.drain()
+        self.server._write_serial(self.chan)
+        self.assertEqual(self.window_updates(), [10])
+
+    def test_window_is_enforced(self):
+        self.line.fill()
+        self.data("x" * 10)
+        self.assertRaises(ProtocolError, self.data, "x" * 7)
+
+
+class ConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.device = os.ttyname(slave)
+        self.server = MultiplexServer(('127.0.0.1', 0), [self.device])
+        self.server.bind()
+        self.address = self.server._listener.getsockname()
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.thread.join()
+        self.server.close()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def connect(self, **kwargs):
+        client = MultiplexClient(self.address, timeout=5.0, **kwargs)
+        self.clients.append(client)
+        client.connect()
+        return client
+
+    def test_compression_negotiated(self):
+        client = self.connect(compression=True)
+        self.assertEqual(client.stats.compression, COMPRESSION_ZLIB)
+
+    def test_compression_not_offered(self):
+        client = self.connect(compression=False)
+        self.assertEqual(client.stats.compression, None)
+
+    def exchange(self, *frames):
+        """
+        Send raw frames and return everything the server sent back until
+        it closed the connection
+        """
+        sock = socket.create_connection(self.address, 5.0)
+        received = ''
+        try:
+            sock.sendall(FrameCodec().pack(frames))
+            data = sock.recv(65536)
+            while data:
+                received += data
+                data = sock.recv(65536)
+        finally:
+            sock.close()
+        return received
+
+    def test_compression_offer_must_be_a_list(self):
+        for offer in (5, "xzlibx", {"zlib": True}):
+            hello = json.dumps({"version": 1, "window": 16,
+                                "compression": offer})
+            # The server hangs up without answering
+            self.assertEqual(self.exchange((FRAME_HELLO, 0, hello)), '')
+        self.assertTrue(self.thread.is_alive())
+
+    def test_data_both_ways(self):
+        line = self.connect(compression=True).open_line(self.device)
+        line.setTimeout(5.0)
+        line.write("ping")
+        self.assertEqual(os.read(self.master, 4), "ping")
+        os.write(self.master, "pong")
+        self.assertEqual(line.read(4), "pong")
+
+    def test_rejected_setting_is_not_cached(self):
+        line = self.connect().open_line(self.device)
+        line.baudrate = 9600
+        self.assertEqual(line.baudrate, 9600)
+        self.assertRaises(
+            pyserial.SerialException, setattr, line, "parity", "Q")
+        self.assertEqual(line.parity, pyserial.PARITY_NONE)
+
+    def test_malformed_open_drops_only_that_client(self):
+        self.exchange(
+            (FRAME_HELLO, 0, _hello_payload(16, None)),
+            (FRAME_OPEN, 1, json.dumps({"port": ["x"]})))
+        self.assertTrue(self.thread.is_alive())
+        line = self.connect().open_line(self.device)
+        line.write("still here")
+        self.assertEqual(os.read(self.master, 10), "still here")
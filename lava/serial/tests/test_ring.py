@@ -0,0 +1,137 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from lava.serial.ring import (
+    RING_COUNTER,
+    RING_DATA_OFFSET,
+    RING_RESERVED_OFFSET,
+    RingError,
+    RingReader,
+    RingWriter,
+)
+
+
+class RingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, "ring")
+        self.writer = RingWriter(self.path, capacity=16)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dirname)
+
+    def test_read_follows_writes(self):
+        reader = RingReader(self.path)
+        self.writer.write("hello")
+        self.assertEqual(reader.read(), ("hello", 0))
+        self.assertEqual(reader.read(), ("", 0))
+
+    def test_read_size(self):
+        reader = RingReader(self.path)
+        self.writer.write("abc")
+        self.assertEqual(reader.read(2), ("ab", 0))
+        self.assertEqual(reader.read(), ("c", 0))
+
+    def test_reader_starts_at_current_data(self):
+        self.writer.write("old")
+        reader = RingReader(self.path)
+        self.writer.write("new")
+        self.assertEqual(reader.read(), ("new", 0))
+
+    def test_from_start(self):
+        self.writer.write("0123456789abcdefXYZ")
+        reader = RingReader(self.path, from_start=True)
+        self.assertEqual(reader.read(), ("3456789abcdefXYZ", 0))
+
+    def test_lost_bytes_across_a_wrap(self):
+        reader = RingReader(self.path)
+        self.writer.write("hello")
+        self.writer.write("0123456789abcdefXYZ")
+        # 24 bytes were written, only the last 16 are still in the ring
+        self.assertEqual(reader.read(), ("3456789abcdefXYZ", 8))
+        self.writer.write("abc")
+        self.assertEqual(reader.read(), ("abc", 0))
+        self.assertEqual(reader.lost, 8)
+
+    def test_write_in_progress_is_lost(self):
+        reader = RingReader(self.path)
+        self.writer.write("A" * 16)
+        # The writer reserved and stored four more bytes but did not
+        # publish them yet, the reader copied the old bytes in the meantime
+        RING_COUNTER.pack_into(self.writer._map, RING_RESERVED_OFFSET, 20)
+        self.writer._map[RING_DATA_OFFSET:RING_DATA_OFFSET + 4] = "BBBB"
+        self.assertEqual(reader.read(), ("A" * 12, 4))
+
+    def test_follow_ends_when_closed(self):
+        path = os.path.join(self.dirname, "closed")
+        writer = RingWriter(path, capacity=16)
+        reader = RingReader(path)
+        writer.write("last words")
+        writer.close(unlink=False)
+        self.assertEqual(list(reader.follow(0)), [("last words", 0)])
+        self.assertTrue(reader.closed)
+
+    def test_follow_ends_when_replaced(self):
+        reader = RingReader(self.path)
+        self.writer.write("x")
+        replacement = RingWriter(self.path, capacity=16)
+        try:
+            self.assertEqual(list(reader.follow(0)), [("x", 0)])
+            self.assertTrue(reader.replaced)
+            self.assertFalse(reader.closed)
+        finally:
+            replacement.close(unlink=False)
+
+    def test_private_by_default(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(mode & 0077, 0)
+
+    def test_mode(self):
+        path = os.path.join(self.dirname, "shared")
+        writer = RingWriter(path, capacity=16, mode=0644)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0644)
+        finally:
+            writer.close()
+
+    def test_planted_files_are_left_alone(self):
+        victim = os.path.join(self.dirname, "victim")
+        with open(victim, "w") as stream:
+            stream.write("precious")
+        # The temporary name used to be predictable
+        os.symlink(victim, "%s.%d" % (self.path, os.getpid()))
+        RingWriter(self.path, capacity=16).close()
+        with open(victim) as stream:
+            self.assertEqual(stream.read(), "precious")
+        self.assertEqual(
+            sorted(os.listdir(self.dirname)),
+            sorted(["victim", "ring.%d" % os.getpid()]))
+
+    def test_not_a_ring(self):
+        path = os.path.join(self.dirname, "junk")
+        with open(path, "w") as stream:
+            stream.write("x" * 100)
+        self.assertRaises(RingError, RingReader, path)
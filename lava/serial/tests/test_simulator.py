@@ -0,0 +1,65 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from lava.serial.simulator import (
+    BoardFarm,
+    LoadDriver,
+    LoadReport,
+    SimulatedBoard,
+    synthetic_boot_log,
+)
+
+
+class SimulatedBoardTests(unittest.TestCase):
+
+    def test_empty_log(self):
+        self.assertRaises(ValueError, SimulatedBoard, [])
+
+    def test_output_is_paced(self):
+        board = SimulatedBoard(["x\r\n"], baudrate=1200)
+        try:
+            board.start()
+            time.sleep(0.5)
+            board.stop()
+            # 1200 baud is 120 bytes per second, log lines and prompts alike
+            self.assertTrue(board.written + board.dropped < 120)
+        finally:
+            board.close()
+
+
+class LoadDriverTests(unittest.TestCase):
+
+    def test_duration_excludes_drain(self):
+        farm = BoardFarm(2, synthetic_boot_log(50), seed=1)
+        try:
+            report = LoadDriver(farm).run(0.5, drain_time=0.5)
+        finally:
+            farm.close()
+        self.assertTrue(report.duration < 0.75, report.duration)
+        self.assertEqual(report.lines, 2)
+        self.assertTrue(report.received > 0)
+        self.assertEqual(report.dropped, 0)
+
+    def test_empty_report(self):
+        report = LoadReport(0, 0.0, 0, 0, [])
+        self.assertEqual(report.throughput, 0.0)
+        self.assertEqual(report.line_throughput, 0.0)
+        self.assertTrue("lines: 0" in str(report))
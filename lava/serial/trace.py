@@ -0,0 +1,132 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hot path tracing
+
+A :class:`Tracer` records timestamped spans into preallocated arrays and
+dumps them in the Chrome trace event format (load the file in
+chrome://tracing or any compatible viewer).
+
+Code that supports tracing keeps a tracer attribute that is None when
+tracing is off and only ever checks it against None on the hot path, so
+tracing costs nothing unless it is turned on.
+"""
+
+import json
+import os
+import thread
+import threading
+import time
+
+
+DEFAULT_CAPACITY = 100000
+
+
+class Tracer(object):
+    """
+    Fixed size in-memory buffer of trace spans
+
+    When the buffer fills up the oldest spans are overwritten so that the
+    dump always shows the most recent activity.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._names = [None] * capacity
+        self._starts = [0.0] * capacity
+        self._ends = [0.0] * capacity
+        self._threads = [0] * capacity
+        # Number of spans ever recorded, the next one goes to this index
+        # (modulo capacity)
+        self._written = 0
+        self._lock = threading.Lock()
+        self._thread_names = {}
+
+    def record(self, name, start, end):
+        """
+        Record a span that started and ended at the specified time.time()
+        """
+        with self._lock:
+            index = self._written % self.capacity
+            self._written += 1
+        self._names[index] = name
+        self._starts[index] = start
+        self._ends[index] = end
+        ident = thread.get_ident()
+        self._threads[index] = ident
+        if ident not in self._thread_names:
+            self._thread_names[ident] = threading.current_thread().name
+
+    def events(self):
+        """
+        Return recorded spans as a list of Chrome trace events
+        """
+        with self._lock:
+            total = self._written
+        if total > self.capacity:
+            indices = range(total % self.capacity, self.capacity)
+            indices += range(total % self.capacity)
+        else:
+            indices = range(total)
+        pid = os.getpid()
+        events = [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": pid,
+            "tid": ident,
+            "args": {"name": name},
+        } for ident, name in self._thread_names.iteritems()]
+        for index in indices:
+            if self._names[index] is None:
+                # Reserved by a thread that did not finish recording yet
+                continue
+            events.append({
+                "name": self._names[index],
+                "ph": "X",
+                "ts": self._starts[index] * 1e6,
+                "dur": (self._ends[index] - self._starts[index]) * 1e6,
+                "pid": pid,
+                "tid": self._threads[index],
+            })
+        return events
+
+    def dump(self, stream):
+        """
+        Write all recorded spans to the stream in Chrome trace event JSON
+        """
+        json.dump({
+            "traceEvents": self.events(),
+            "displayTimeUnit": "ms",
+        }, stream)
+
+
+def acquire(lock, tracer, name):
+    """
+    Acquire the lock, recording the time spent waiting for it as a span
+    with the specified name if the lock was contended
+
+    Uncontended acquisitions are not recorded so that the trace only shows
+    the waits. Without a tracer this is a plain lock.acquire().
+    """
+    if tracer is None:
+        lock.acquire()
+    elif not lock.acquire(False):
+        start = time.time()
+        lock.acquire()
+        tracer.record(name, start, time.time())
@@ -0,0 +1,162 @@
+# Copyright (C) 2011 Linaro Limited
+#
+# Author: Zygmunt Krynicki <zygmunt.krynicki@linaro.org>
+#
+# This file is part of LAVA Serial
+#
+# LAVA Serial is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation
+#
+# LAVA Serial is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Serial.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Background sampling of UART error and overrun counters
+
+The counters tell apart the usual reasons for lost characters:
+
+    overrun
+        the UART hardware FIFO overflowed before the kernel drained it
+    buf_overrun
+        the kernel tty buffer overflowed because the reader was too slow
+    frame, parity
+        the line settings do not match the other side (or the line is
+        noisy)
+"""
+
+import threading
+import time
+
+
+DEFAULT_INTERVAL = 1.0
+# Counters worth showing to people chasing lost characters
+ERROR_FIELDS = ('overrun', 'buf_overrun', 'frame', 'parity', 'brk')
+
+
+class UartSample(object):
+    """
+    Counters read at a specific time
+    """
+
+    def __init__(self, timestamp, counts):
+        self.timestamp = timestamp
+        self.counts = counts
+
+    def delta(self, other):
+        """
+        Changes of all counters since the other (earlier) sample
+        """
+        return dict(
+            (name, value - other.counts[name])
+            for name, value in self.counts.iteritems())
+
+    def rx_rate(self, other):
+        """
+        Received bytes per second since the other (earlier) sample
+        """
+        elapsed = self.timestamp - other.timestamp
+        if elapsed <= 0:
+            return 0.0
+        return (self.counts['rx'] - other.counts['rx']) / elapsed
+
+
+class UartMonitor(object):
+    """
+    Sample the interrupt counters of a serial line in the background
+
+    Serial lines that cannot report the counters (anything without a
+    get_icount() method or one that returns None) are not sampled at all,
+    supported is False for them.
+
+    Besides the first and the two most recent samples the monitor keeps the
+    highest receive rate seen between two consecutive samples, bursts that
+    overflow a FIFO are easy to miss in an average over the whole session.
+    """
+
+    def __init__(self, serial, interval=DEFAULT_INTERVAL):
+        self.serial = serial
+        self.interval = interval
+        self.first = None
+        self.previous = None
+        self.latest = None
+        self.peak_rx_rate = 0.0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def supported(self):
+        return self.first is not None
+
+    def sample(self):
+        """
+        Read the counters now, returns the new UartSample or None
+        """
+        get_icount = getattr(self.serial, "get_icount", None)
+        if get_icount is None:
+            return None
+        try:
+            counts = get_icount()
+        except EnvironmentError:
+            # The port went away, the reader will notice that too
+            counts = None
+        if counts is None:
+            return None
+        sample = UartSample(time.time(), counts)
+        with self._lock:
+            if self.first is None:
+                self.first = sample
+            else:
+                self.peak_rx_rate = max(
+                    self.peak_rx_rate, sample.rx_rate(self.latest))
+            self.previous, self.latest = self.latest, sample
+        return sample
+
+    def start(self):
+        """
+        Take the first sample and keep sampling in the background if the
+        serial line supports it
+        """
+        if self.sample() is None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="UART counters for %s" % self.serial.portstr)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def rx_rate(self):
+        """
+        Received bytes per second over the last sampling interval
+        """
+        with self._lock:
+            if self.previous is None:
+                return 0.0
+            return self.latest.rx_rate(self.previous)
+
+    def totals(self):
+        """
+        Changes of all counters since monitoring started, None if the
+        serial line does not support them
+        """
+        with self._lock:
+            if self.first is None:
+                return None
+            return self.latest.delta(self.first)
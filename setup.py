@@ -41,6 +41,10 @@ setup(
     serial = lava.serial.commands:SerialCommand
     [lava.serial.commands]
     console = lava.serial.commands:ConsoleCommand
+    service = lava.serial.commands:ServiceCommand
+    tail = lava.serial.commands:TailCommand
+    simulate = lava.serial.commands:SimulateCommand
+    loadtest = lava.serial.commands:LoadTestCommand
     """,
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -57,6 +61,7 @@ setup(
     setup_requires=[
         'versiontools >= 1.8.2'
     ],
+    test_suite='lava.serial.tests.test_suite',
     zip_safe=True,
     include_package_data=True
 )